@@ -0,0 +1,365 @@
+"""
+    Benchmarks the stages of the keyword selection script.
+
+    Generates synthetic keyword and key pair metric files (same csv format as
+    the sample data, seeded, so runs are reproducible) for a range of key
+    counts, and measures run time and peak memory of each stage
+    (read_in_keydata, calc_keylist_permutations, calc_key_scores,
+    calc_keylist_scores, calc_keypair_scores and writing the out_*.csv files
+    of process_all) for each combination of key count and keylist length
+    limits. Key counts too large to enumerate all keylists are measured with
+    the search methods of process (streaming exhaustive search as long as
+    the number of keylists is small enough, see count_keylists).
+
+    Results are stored as json, so they can be compared between versions.
+
+    :copyright: (c) 2014 by Szilard Szasz-Toth.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import contextlib
+import csv
+import io
+import json
+import os
+import platform
+import random
+import string
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import keylist_selector as ks
+
+HEADER = ['lang', 'key', 'traffic', 'iphone_diff', 'iphone_apps', 'ipad_diff',
+    'ipad_apps', 'req_time', 'created']
+
+STAGES = ('read_in_keydata', 'calc_keylist_permutations', 'calc_key_scores',
+    'calc_keylist_scores', 'calc_keypair_scores', 'csv_export')
+
+# Methods of process measured for key counts of the search sweep
+SEARCH_METHODS = ('exhaustive', 'branch_bound')
+
+def generate_keydata(n_keys, seed, key_file, keypair_file, missing=0.0):
+    """Writes synthetic keyword and key pair metric files.
+
+    Args:
+        n_keys: Number of keywords.
+        seed: Random seed, equal seeds generate equal files.
+        key_file: Name of keyword output file.
+        keypair_file: Name of key pair output file, holding all ordered
+            pairs "key1 key2" of distinct keywords.
+        missing: Fraction of key pairs to leave out.
+    """
+    rand = random.Random(seed)
+
+    keys = []
+    while len(keys) < n_keys:
+        key = ''.join(rand.choice(string.ascii_lowercase) for i in
+            range(rand.randint(3, 10)))
+        if key not in keys:
+            keys.append(key)
+
+    def get_row(key):
+        return ['US', key, round(rand.uniform(0, 10), 1),
+            round(rand.uniform(0, 10), 1), int(rand.lognormvariate(8, 2)),
+            round(rand.uniform(0, 10), 1), int(rand.lognormvariate(8, 2)),
+            round(rand.uniform(2, 5), 3), '2014-12-14']
+
+    with open(key_file, 'w', newline='', encoding='utf8') as csvfile:
+        csvwriter = csv.writer(csvfile)
+        csvwriter.writerow(HEADER)
+        for key in keys:
+            csvwriter.writerow(get_row(key))
+
+    with open(keypair_file, 'w', newline='', encoding='utf8') as csvfile:
+        csvwriter = csv.writer(csvfile)
+        csvwriter.writerow(HEADER)
+        for key1 in keys:
+            for key2 in keys:
+                if key1 != key2 and rand.random() >= missing:
+                    csvwriter.writerow(get_row(key1 + " " + key2))
+
+def run_stages(key_file, keypair_file, max_keylist_len, min_keylist_len,
+               w_factors, apps_base, keylen_base, export_dir):
+    """Runs all stages once.
+
+    Yields:
+        Tuples (stage, function, arguments) and the result of each stage
+        has to be sent back into the generator.
+    """
+    key_data = yield ('read_in_keydata', ks.read_in_keydata, (key_file,
+        False))
+    keypair_data = ks.read_in_keydata(keypair_file, False)
+    key_lists = yield ('calc_keylist_permutations',
+        ks.calc_keylist_permutations, (key_data.keys, max_keylist_len,
+        min_keylist_len))
+    yield ('calc_key_scores', calc_all_key_scores, (key_data, keypair_data,
+        w_factors, apps_base, keylen_base))
+    yield ('calc_keylist_scores', ks.calc_keylist_scores, (key_lists,
+        key_data, max_keylist_len))
+    yield ('calc_keypair_scores', ks.calc_keypair_scores, (key_lists,
+        keypair_data, max_keylist_len))
+    files = collect_outputs(key_lists, key_data, keypair_data,
+        max_keylist_len, w_factors, apps_base, keylen_base)
+    yield ('csv_export', export_all, (export_dir, files))
+
+def calc_all_key_scores(key_data, keypair_data, w_factors, apps_base,
+                        keylen_base):
+    """Calculates keyword and key pair scores, see calc_key_scores."""
+    ks.calc_key_scores(key_data, w_factors, apps_base, keylen_base)
+    ks.calc_key_scores(keypair_data, w_factors, apps_base, keylen_base)
+
+class RowCollector(object):
+    """Collects output files instead of writing them, see write_output."""
+
+    def __init__(self):
+        self.files = []
+
+    def submit(self, file, header, rows, message="", **fmtparams):
+        self.files.append((file, header, list(rows), fmtparams))
+
+def collect_outputs(key_lists, key_data, keypair_data, max_keylist_len,
+                    w_factors, apps_base, keylen_base):
+    """Builds the rows of all out_*.csv files of process_all.
+
+    Returns:
+        A list of (file, header, rows, fmtparams) tuples, see write_output.
+    """
+    collector = RowCollector()
+    files = ks.OUTPUT_FILES
+    with contextlib.redirect_stdout(io.StringIO()):
+        ks.write_output(files['keylists'], None, key_lists, "", collector,
+            delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+        ks.calc_key_scores(key_data, w_factors, apps_base, keylen_base,
+            files['key_scores'], collector)
+        keylist_scores = ks.calc_keylist_scores(key_lists, key_data,
+            max_keylist_len, files['keylist_scores'], collector)
+        ks.calc_key_scores(keypair_data, w_factors, apps_base, keylen_base,
+            files['keypair_scores'], collector)
+        keypair_scores = ks.calc_keypair_scores(key_lists, keypair_data,
+            max_keylist_len, files['keylist_keypair_scores'], collector)
+
+    rows = []
+    for (key_list, key_score, pair_score) in zip(key_lists, keylist_scores,
+            keypair_scores):
+        keylist = ",".join(key_list)
+        rows.append([keylist, key_score, pair_score, 2/3*key_score +
+            1/3*pair_score, len(keylist), len(key_list)])
+    collector.submit(files['keylist_scores_cum'], ['keylist', 'key_score',
+        'keypair_score', 'cumulative_score', 'length', 'words'], rows,
+        delimiter=';', quoting=csv.QUOTE_NONE)
+    return collector.files
+
+def export_all(export_dir, files):
+    """Writes all collected output files to export_dir."""
+    for (file, header, rows, fmtparams) in files:
+        ks.write_output(os.path.join(export_dir, file), header, rows,
+            **fmtparams)
+
+def measure(key_file, keypair_file, max_keylist_len, min_keylist_len,
+            w_factors, apps_base, keylen_base, repeat=3):
+    """Measures run time and peak memory of each stage.
+
+    Run time is the minimum over repeat runs. Peak memory (of memory
+    allocated by python during a stage) is measured in a separate traced
+    run, as tracing slows down all stages.
+
+    Returns:
+        A dict of stage: {'seconds', 'peak_bytes'}, and the number of
+        candidate keylists.
+    """
+    results = {stage: {'seconds': float('inf'), 'peak_bytes': 0} for stage
+        in STAGES}
+    n_keylists = 0
+
+    with tempfile.TemporaryDirectory() as export_dir:
+        for run in range(repeat + 1):
+            traced = run == repeat
+            stages = run_stages(key_file, keypair_file, max_keylist_len,
+                min_keylist_len, w_factors, apps_base, keylen_base,
+                export_dir)
+            result = None
+            while True:
+                try:
+                    (stage, function, args) = stages.send(result)
+                except StopIteration:
+                    break
+
+                with contextlib.redirect_stdout(io.StringIO()):
+                    if traced:
+                        tracemalloc.start()
+                        result = function(*args)
+                        results[stage]['peak_bytes'] = \
+                            tracemalloc.get_traced_memory()[1]
+                        tracemalloc.stop()
+                    else:
+                        start_time = time.perf_counter()
+                        result = function(*args)
+                        results[stage]['seconds'] = min(
+                            results[stage]['seconds'],
+                            time.perf_counter() - start_time)
+
+                if stage == 'calc_keylist_permutations':
+                    n_keylists = len(result)
+
+    return (results, n_keylists)
+
+def measure_search(key_data, keypair_data, max_keylist_len, min_keylist_len,
+                   w_factors, apps_base, keylen_base, method, repeat=3):
+    """Measures run time and peak memory of a selection with process.
+
+    Exhaustive selections stream candidate keylists without exporting them,
+    see process. Run time and peak memory are measured as in measure.
+
+    Returns:
+        A dict {'seconds', 'peak_bytes'}.
+    """
+    result = {'seconds': float('inf'), 'peak_bytes': 0}
+    for run in range(repeat + 1):
+        traced = run == repeat
+        with contextlib.redirect_stdout(io.StringIO()):
+            if traced:
+                tracemalloc.start()
+            start_time = time.perf_counter()
+            ks.process(key_data, keypair_data, True, max_keylist_len,
+                min_keylist_len, w_factors, apps_base, keylen_base, method)
+            if traced:
+                result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            else:
+                result['seconds'] = min(result['seconds'],
+                    time.perf_counter() - start_time)
+    return result
+
+def get_version():
+    """Returns the git commit of the script, if available."""
+    try:
+        return subprocess.check_output(['git', 'describe', '--always',
+            '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+def run_benchmark(key_counts, limits, seed, repeat=3, missing=0.0,
+                  apps_base=3500, keylen_base=6, search_counts=(),
+                  max_keylists=1000000):
+    """Benchmarks all stages for all key counts and length limits.
+
+    Args:
+        key_counts: List of numbers of input keywords.
+        search_counts: List of numbers of input keywords to measure the
+            SEARCH_METHODS of process for (stages process_<method>).
+        max_keylists: Maximum number of candidate keylists to measure an
+            exhaustive search for (see count_keylists), larger ones are
+            skipped.
+        limits: List of (max_keylist_len, min_keylist_len) tuples.
+        seed: Random seed of synthetic input data.
+        repeat: Number of timed runs per stage.
+        missing: Fraction of key pairs to leave out of the input data.
+        apps_base: Integer value used to normalize key metric number of apps.
+        keylen_base: Integer value used to normalize keyword length metric.
+
+    Returns:
+        A dict with environment info and a list of results, one for each
+        key count, length limits and stage.
+    """
+    w_factors = {'w_diff':0.55, 'w_traffic':0.35,
+                'w_apps':0.05, 'w_keylen':0.05}
+
+    report = {'version': get_version(), 'python': platform.python_version(),
+        'platform': platform.platform(), 'seed': seed, 'repeat': repeat,
+        'missing': missing, 'results': []}
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        for n_keys in key_counts:
+            key_file = os.path.join(data_dir, 'keys_%d.csv' % n_keys)
+            keypair_file = os.path.join(data_dir, 'keypairs_%d.csv' % n_keys)
+            generate_keydata(n_keys, seed, key_file, keypair_file, missing)
+
+            for (max_keylist_len, min_keylist_len) in limits:
+                (results, n_keylists) = measure(key_file, keypair_file,
+                    max_keylist_len, min_keylist_len, w_factors, apps_base,
+                    keylen_base, repeat)
+                for stage in STAGES:
+                    report['results'].append({'n_keys': n_keys,
+                        'max_keylist_len': max_keylist_len,
+                        'min_keylist_len': min_keylist_len,
+                        'n_keylists': n_keylists, 'stage': stage,
+                        'seconds': results[stage]['seconds'],
+                        'peak_bytes': results[stage]['peak_bytes']})
+                    print("%3d keys, len %d-%d, %14d keylists, %-26s %9.4fs "
+                        "%9.1f MB" % (n_keys, min_keylist_len,
+                        max_keylist_len, n_keylists, stage,
+                        results[stage]['seconds'],
+                        results[stage]['peak_bytes'] / (1 << 20)))
+
+        for n_keys in search_counts:
+            key_file = os.path.join(data_dir, 'keys_%d.csv' % n_keys)
+            keypair_file = os.path.join(data_dir, 'keypairs_%d.csv' % n_keys)
+            generate_keydata(n_keys, seed, key_file, keypair_file, missing)
+            key_data = ks.read_in_keydata(key_file, False)
+            keypair_data = ks.read_in_keydata(keypair_file, False)
+
+            for (max_keylist_len, min_keylist_len) in limits:
+                n_keylists = ks.count_keylists(key_data.keys,
+                    max_keylist_len, min_keylist_len)
+                for method in SEARCH_METHODS:
+                    stage = 'process_' + method
+                    if method == 'exhaustive' and n_keylists > max_keylists:
+                        print("%3d keys, len %d-%d, %14d keylists, %-26s "
+                            "skipped" % (n_keys, min_keylist_len,
+                            max_keylist_len, n_keylists, stage))
+                        continue
+                    result = measure_search(key_data, keypair_data,
+                        max_keylist_len, min_keylist_len, w_factors,
+                        apps_base, keylen_base, method, repeat)
+                    report['results'].append({'n_keys': n_keys,
+                        'max_keylist_len': max_keylist_len,
+                        'min_keylist_len': min_keylist_len,
+                        'n_keylists': n_keylists, 'stage': stage,
+                        'seconds': result['seconds'],
+                        'peak_bytes': result['peak_bytes']})
+                    print("%3d keys, len %d-%d, %14d keylists, %-26s %9.4fs "
+                        "%9.1f MB" % (n_keys, min_keylist_len,
+                        max_keylist_len, n_keylists, stage,
+                        result['seconds'], result['peak_bytes'] / (1 << 20)))
+
+    return report
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Keyword selection benchmark")
+    parser.add_argument("--keys", default="10,14,18",
+                        help="Comma separated numbers of input keywords")
+    parser.add_argument("--search_keys", default="25,35,60",
+                        help="Comma separated numbers of input keywords to " \
+                            "measure the search methods of process for")
+    parser.add_argument("--max_keylists", default=1000000, type=int,
+                        help="Maximum number of keylists to measure an " \
+                            "exhaustive search for")
+    parser.add_argument("--limits", default="100:90,60:50",
+                        help="Comma separated max:min keylist lengths")
+    parser.add_argument("--seed", default=1, type=int,
+                        help="Random seed of synthetic input data")
+    parser.add_argument("--repeat", default=3, type=int,
+                        help="Number of timed runs per stage")
+    parser.add_argument("--missing", default=0.0, type=float,
+                        help="Fraction of key pairs left out of input data")
+    parser.add_argument("--output", default="benchmark_results.json",
+                        help="Results file")
+    args = parser.parse_args()
+
+    key_counts = [int(n) for n in args.keys.split(",") if n]
+    search_counts = [int(n) for n in args.search_keys.split(",") if n]
+    limits = [tuple(int(n) for n in limit.split(":")) for limit in
+        args.limits.split(",")]
+
+    report = run_benchmark(key_counts, limits, args.seed, args.repeat,
+        args.missing, search_counts=search_counts,
+        max_keylists=args.max_keylists)
+
+    with open(args.output, 'w') as jsonfile:
+        json.dump(report, jsonfile, indent=2)
+    print("Benchmark results exported to file: %s" % args.output)
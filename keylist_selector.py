@@ -29,14 +29,53 @@
     :license: MIT, see LICENSE for more details.
 """
 
+import cProfile
+import contextlib
+import collections
 import csv
+import gzip
+import hashlib
+import heapq
+import http.server
+import io
 import itertools
+import json
+import logging
+import math
+import mmap
+import multiprocessing
+import operator
+import os
+import pickle
+import queue
+import random
+import socket
+import socketserver
+import struct
+import sys
+import threading
 import time
+import tracemalloc
+from array import array
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+try:
+    import numpy
+except ImportError:
+    # Metric columns are scored element by element without numpy
+    numpy = None
 
 
 class KeyDataStore(object):
     """Object to store keyword data.
 
+    Keyword metrics are stored column-wise in contiguous float64 arrays.
+
     Attributes:
         keys: List of input keywords used for the selection.
         scores: Aggregated score of each input keyword, calculated as a weighted
@@ -49,85 +88,675 @@ class KeyDataStore(object):
         avg_diff: The average between iphone_diff and ipad_diff.
         avg_apps: The average between iphone_apps and ipad_apps.
         key_len: Char length of each input keyword.
+        index: Hash index mapping each keyword to its position in keys (first
+            occurrence of a keyword wins). Built on first use and kept in
+            sync by add_key and extend.
     """
-    
-    keys = []
-    scores = []
-    traffic = []
-    iphone_diff = []
-    iphone_apps = []
-    ipad_diff = []
-    ipad_apps = []
-    avg_diff = []
-    avg_apps = []
-    key_len = []
+
+    __slots__ = ('keys', 'scores', 'traffic', 'iphone_diff', 'iphone_apps',
+        'ipad_diff', 'ipad_apps', 'avg_diff', 'avg_apps', 'key_len', '_index')
 
     def __init__(self):
         self.keys = []
-        self.scores = []
-        self.traffic = []
-        self.iphone_diff = []
-        self.iphone_apps = []
-        self.ipad_diff = []
-        self.ipad_apps = []    
-        self.avg_diff = []
-        self.avg_apps = []
-        self.key_len = []
-
-def read_in_keydata(file):
+        self.scores = array('d')
+        self.traffic = array('d')
+        self.iphone_diff = array('d')
+        self.iphone_apps = array('d')
+        self.ipad_diff = array('d')
+        self.ipad_apps = array('d')
+        self.avg_diff = array('d')
+        self.avg_apps = array('d')
+        self.key_len = array('d')
+        self._index = None
+
+    @property
+    def index(self):
+        if self._index is None:
+            n = len(self.keys)
+
+            # Insert in reverse order, so the first occurrence of a key wins
+            self._index = dict(zip(reversed(self.keys), range(n-1, -1, -1)))
+        return self._index
+
+    @index.setter
+    def index(self, index):
+        self._index = index
+
+    def add_key(self, key, traffic, iphone_diff, iphone_apps, ipad_diff,
+                ipad_apps):
+        """Appends a keyword and its metrics."""
+        if self._index is not None:
+            self._index.setdefault(key, len(self.keys))
+        self.keys.append(key)
+        self.key_len.append(len(key))
+        self.traffic.append(traffic)
+        self.iphone_diff.append(iphone_diff)
+        self.iphone_apps.append(iphone_apps)
+        self.ipad_diff.append(ipad_diff)
+        self.ipad_apps.append(ipad_apps)
+        self.avg_diff.append(0.5 * (iphone_diff + ipad_diff))
+        self.avg_apps.append(0.5 * (iphone_apps + ipad_apps))
+
+    def extend(self, keys, traffic, iphone_diff, iphone_apps, ipad_diff,
+               ipad_apps):
+        """Appends columns of keywords and their metrics."""
+        offset = len(self.keys)
+
+        if self._index is not None:
+            # Insert in reverse order, so the first occurrence of a key wins
+            index = dict(zip(reversed(keys),
+                range(offset + len(keys) - 1, offset - 1, -1)))
+            for key in index.keys() & self._index.keys():
+                del index[key]
+            self._index.update(index)
+
+        self.keys.extend(keys)
+        self.key_len.extend(map(len, keys))
+        self.traffic.extend(traffic)
+        self.iphone_diff.extend(iphone_diff)
+        self.iphone_apps.extend(iphone_apps)
+        self.ipad_diff.extend(ipad_diff)
+        self.ipad_apps.extend(ipad_apps)
+        self.avg_diff.extend(map((0.5).__mul__,
+            map(operator.add, iphone_diff, ipad_diff)))
+        self.avg_apps.extend(map((0.5).__mul__,
+            map(operator.add, iphone_apps, ipad_apps)))
+
+    def update_key(self, i, traffic, iphone_diff, iphone_apps, ipad_diff,
+                   ipad_apps):
+        """Replaces the metrics of the keyword at position i."""
+        self.traffic[i] = traffic
+        self.iphone_diff[i] = iphone_diff
+        self.iphone_apps[i] = iphone_apps
+        self.ipad_diff[i] = ipad_diff
+        self.ipad_apps[i] = ipad_apps
+        self.avg_diff[i] = 0.5 * (iphone_diff + ipad_diff)
+        self.avg_apps[i] = 0.5 * (iphone_apps + ipad_apps)
+
+    def rebuild_index(self):
+        """Rebuilds the keyword index on next use, after keys were changed."""
+        self._index = None
+
+class Metrics(object):
+    """Object to record run time, memory and counters of processing stages.
+
+    Stages are recorded with the stage context manager, repeated stages add
+    up. Stages must not be nested.
+
+    Attributes:
+        stages: Dict of stage name to dict of number of calls, wall time in
+            seconds, peak memory allocated by python in bytes (only with
+            trace_memory set) and max resident set size of the process in
+            bytes after the stage (if available).
+        counters: Dict of counter name to count.
+        trace_memory: Trace peak memory of stages with tracemalloc (slows
+            down all stages).
+        profiler: cProfile.Profile enabled during all stages (optional).
+    """
+
+    def __init__(self, trace_memory=False, profile=False):
+        self.stages = {}
+        self.counters = {}
+        self.trace_memory = trace_memory
+        self.profiler = cProfile.Profile() if profile else None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Records wall time and peak memory of the enclosed stage."""
+        tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        elif self.trace_memory:
+            tracemalloc.reset_peak()
+        if self.profiler is not None:
+            self.profiler.enable()
+        start_time = time.perf_counter()
+        try:
+            yield self
+        finally:
+            seconds = time.perf_counter() - start_time
+            if self.profiler is not None:
+                self.profiler.disable()
+
+            stats = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0})
+            stats['calls'] += 1
+            stats['seconds'] += seconds
+            if self.trace_memory:
+                stats['peak_bytes'] = max(stats.get('peak_bytes', 0),
+                    tracemalloc.get_traced_memory()[1])
+                if tracing:
+                    tracemalloc.stop()
+            if resource is not None:
+                # ru_maxrss is given in KB on Linux and in bytes on macOS
+                stats['max_rss_bytes'] = resource.getrusage(
+                    resource.RUSAGE_SELF).ru_maxrss * (1 if
+                    sys.platform == 'darwin' else 1024)
+
+    def count(self, name, n=1):
+        """Adds n to counter name."""
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_counters(self, counters):
+        """Adds a dict of counts to the counters."""
+        for (name, n) in counters.items():
+            self.count(name, n)
+
+    def count_iter(self, name, iterable):
+        """Yields all items of iterable, adds their number to counter name."""
+        n = 0
+        try:
+            for n, item in enumerate(iterable, 1):
+                yield item
+        finally:
+            self.count(name, n)
+
+    def to_dict(self):
+        """Returns all stages and counters as dict."""
+        return {'stages': self.stages, 'counters': self.counters}
+
+    def write(self, file):
+        """Exports all stages and counters as json."""
+        with open(file, 'w') as jsonfile:
+            json.dump(self.to_dict(), jsonfile, indent=2)
+        print("Metrics exported to file: %s" % file)
+
+    def log(self, logger=None):
+        """Emits one log record for each stage and one for all counters."""
+        logger = logger or logging.getLogger(__name__)
+        for (name, stats) in self.stages.items():
+            logger.info("stage %s: %s", name, json.dumps(stats),
+                extra={'stage': name, 'metrics': stats})
+        logger.info("counters: %s", json.dumps(self.counters),
+            extra={'counters': self.counters})
+
+    def dump_profile(self, file):
+        """Exports profile stats of all stages, see pstats."""
+        if self.profiler is not None:
+            self.profiler.dump_stats(file)
+            print("Profile exported to file: %s" % file)
+
+def measure_stage(metrics, name):
+    """Returns a context manager recording stage name in metrics, if given."""
+    if metrics is None:
+        return contextlib.nullcontext()
+    return metrics.stage(name)
+
+def read_in_keydata(file, use_snapshot=True):
     """Read in keyword data from input file.
     
     Fetches list of keywords with corresponding keyword metrics and stores
     data in object KeyDataStore (keyword metrics are scraped from different 
     sources and processed in a separate script).
 
+    Column positions are resolved once from the header and the file is read
+    in large blocks, split into lines and cells without the csv module
+    (unless a block holds quoted cells) and converted column by column.
+    Files ending with .gz are read as gzip files. A binary snapshot of the
+    parsed data is stored next to the input file (see
+    write_keydata_snapshot) and read in instead of the input file on
+    subsequent runs, as long as size and modification time of the input
+    file are unchanged.
+
     Args:
         file: Name of csv input file holding all keyword data.
+        use_snapshot: Read and write binary snapshot of the input file 
+            (optional).
 
     Returns:
         A KeyDataStore object that stores all information of the input keys.
     """
 
     key_data = KeyDataStore()
-    file_header = []
+    snapshot_file = file + ".kds"
 
     try:
-        csvfile = open(file, 'r', newline='', encoding='utf-8')
+        stat = os.stat(file)
+    except OSError as e:
+        print('Exception: %s' % e)
+        return key_data
+
+    if use_snapshot:
+        key_data = read_keydata_snapshot(snapshot_file, stat)
+        if key_data is not None:
+            return key_data
+        key_data = KeyDataStore()
+
+    try:
+        csvfile = open_keydata_file(file)
     except IOError as e:
         print('Exception: %s' % e)
         return key_data
 
-    csvreader = csv.reader(csvfile, delimiter=',', quotechar='|')
-    
-    for i, row in enumerate(csvreader):
+    with csvfile:
+        # Resolve column positions from header
+        file_header = split_keydata_line(csvfile.readline())
+        try:
+            columns = [file_header.index(name) for name in ("key", "traffic",
+                "iphone_diff", "iphone_apps", "ipad_diff", "ipad_apps")]
+        except ValueError as e:
+            print('Exception: %s' % e)
+            return key_data
+
+        # Convert blocks of complete lines into columns. Cells of a block are
+        # split at once, each line followed by a newline cell, so a column is
+        # every (n+1)-th cell if all newline cells are in place, i.e. all
+        # rows have the n cells of the header. Rows of other length are
+        # rejected
+        n = len(file_header)
+        keys = []
+        metrics = [array('d') for column in columns[1:]]
+        rest = ""
+        while True:
+            block = csvfile.read(READ_BUFFER_SIZE)
+            text = (rest + block).replace('\r\n', '\n')
+            end = text.rfind('\n') + 1 if block else len(text)
+            (text, rest) = (text[:end].rstrip('\n') + '\n', text[end:])
+            cells = text.replace('\n', ',\n,').split(',')
+            cells.pop()
+            lines = len(cells) // (n+1)
+            if ('|' in text or len(cells) != (n+1) * lines or
+                    cells[n::n+1].count('\n') != lines):
+                # Quoted cells, blank lines or rows of other length, split
+                # line by line
+                rows = list(csv.reader(filter(None, text.split('\n')),
+                    delimiter=',', quotechar='|'))
+                for row in rows:
+                    if len(row) != n:
+                        print('Exception: Row with %d instead of %d cells: %s'
+                            % (len(row), n, ",".join(row)))
+                        return KeyDataStore()
+                get_column = lambda column: map(operator.itemgetter(column),
+                    rows)
+            else:
+                get_column = lambda column: cells[column::n+1]
+            keys.extend(get_column(columns[0]))
+            for (metric, column) in zip(metrics, columns[1:]):
+                metric.extend(map(float, get_column(column)))
+            if not block:
+                break
+
+        key_data.extend(keys, *metrics)
+
+    if use_snapshot:
+        write_keydata_snapshot(snapshot_file, key_data, stat)
+
+    return key_data
+
+def open_keydata_file(file):
+    """Opens csv (or gzip compressed csv) input file for reading."""
+    if file.endswith(".gz"):
+        return io.TextIOWrapper(io.BufferedReader(gzip.open(file, 'rb'),
+            READ_BUFFER_SIZE), newline='', encoding='utf-8-sig')
+    else:
+        return open(file, 'r', READ_BUFFER_SIZE, newline='',
+            encoding='utf-8-sig')
+
+def read_in_keypair_data(file, keys, use_index=False):
+    """Read in key pair data of the pairs of input keywords only.
+
+    Streams the key pair input file and keeps only rows of search phrases
+    "key1 key2" of two distinct input keys, so memory scales with the
+    number of input keys instead of the size of the file. Rows are split
+    without the csv module unless they hold quoted cells. With use_index
+    set, rows are looked up in a sorted index of the input file instead
+    (see build_keypair_index, not available for gzip files).
 
-        # Store header
-        if (i == 0):
-            file_header = row
+    Args:
+        file: Name of csv input file holding key pair data.
+        keys: List of input keywords.
+        use_index: Look up rows in sorted index of the input file, which is
+            built if missing or outdated (optional).
+
+    Returns:
+        A KeyDataStore object with the key pair data of the input keys.
+    """
+
+    key_data = KeyDataStore()
+    pairs = set(key1 + " " + key2 for key1 in keys for key2 in keys
+        if key1 != key2)
+
+    try:
+        if use_index and not file.endswith(".gz"):
+            (header, rows) = find_keypair_rows(file, pairs)
         else:
-            key = row[file_header.index("key")]
-            key_data.keys.append(key)
-            key_data.key_len.append(len(key))
+            with open_keydata_file(file) as csvfile:
+                header = split_keydata_line(csvfile.readline())
+                key = header.index("key")
+                rows = []
+                for line in csvfile:
+                    row = split_keydata_line(line)
+                    if row[key] in pairs:
+                        rows.append(row)
+    except (IOError, ValueError) as e:
+        print('Exception: %s' % e)
+        return key_data
+
+    try:
+        columns = [header.index(name) for name in ("key", "traffic",
+            "iphone_diff", "iphone_apps", "ipad_diff", "ipad_apps")]
+    except ValueError as e:
+        print('Exception: %s' % e)
+        return key_data
+    key_data.extend([row[columns[0]] for row in rows],
+        *[[float(row[column]) for row in rows] for column in columns[1:]])
 
-            key_data.traffic.append(float(
-                row[file_header.index("traffic")]))
-            
-            iphone_diff = float(row[file_header.index("iphone_diff")])
-            iphone_apps = float(row[file_header.index("iphone_apps")])
-            ipad_diff = float(row[file_header.index("ipad_diff")])
-            ipad_apps = float(row[file_header.index("ipad_apps")])
-            
-            key_data.iphone_diff.append(iphone_diff)
-            key_data.iphone_apps.append(iphone_apps)
-            key_data.ipad_diff.append(ipad_diff)
-            key_data.ipad_apps.append(ipad_apps)
-            
-            key_data.avg_diff.append(0.5 * (iphone_diff + ipad_diff))
-            key_data.avg_apps.append(0.5 * (iphone_apps + ipad_apps))
-        
     return key_data
-            
-def calc_keylist_permutations(keys, max_keylist_len, min_keylist_len, file=""):
+
+def split_keydata_line(line):
+    """Splits a line of a keyword data file into cells."""
+    if '|' in line:
+        return next(csv.reader([line], delimiter=',', quotechar='|'), [])
+    return line.rstrip('\r\n').split(',')
+
+# Key pair index header: magic, input file size and mtime, number of rows
+KEYPAIR_INDEX_MAGIC = b'KPI1' + sys.byteorder[0].encode() + b'   '
+KEYPAIR_INDEX_HEADER = struct.Struct('8sQqQ')
+
+def build_keypair_index(file, index_file, stat):
+    """Writes sorted index of a key pair input file.
+
+    The index holds a header and the byte offsets (uint64) of all rows of
+    the input file, sorted by key (and offset for equal keys), so rows of
+    a key can be found by binary search.
+
+    Args:
+        file: Name of csv input file holding key pair data.
+        index_file: Name of index file.
+        stat: os.stat_result of the input file.
+
+    Returns:
+        An array of sorted row offsets.
+    """
+    entries = []
+    with open(file, 'rb', READ_BUFFER_SIZE) as csvfile:
+        header = split_keydata_line(csvfile.readline().decode('utf-8-sig'))
+        key = header.index("key")
+        offset = csvfile.tell()
+        for line in csvfile:
+            if b'|' in line:
+                entries.append((split_keydata_line(line.decode('utf-8'))[key]
+                    .encode('utf-8'), offset))
+            else:
+                entries.append((line.split(b',', key + 1)[key], offset))
+            offset += len(line)
+    entries.sort()
+
+    offsets = array('Q', [offset for (key, offset) in entries])
+    try:
+        with open(index_file, 'wb') as index:
+            index.write(KEYPAIR_INDEX_HEADER.pack(KEYPAIR_INDEX_MAGIC,
+                stat.st_size, stat.st_mtime_ns, len(offsets)))
+            offsets.tofile(index)
+    except IOError as e:
+        print('Exception: Could not write key pair index. %s' % e)
+    return offsets
+
+def read_keypair_index(index_file, stat):
+    """Reads sorted index of a key pair input file, see build_keypair_index.
+
+    Returns:
+        An array of sorted row offsets or None if there is no valid index for
+        the input file.
+    """
+    try:
+        with open(index_file, 'rb') as index:
+            data = index.read()
+    except IOError:
+        return None
+    if len(data) < KEYPAIR_INDEX_HEADER.size:
+        return None
+    (magic, size, mtime, n_rows) = KEYPAIR_INDEX_HEADER.unpack_from(data)
+    if (magic != KEYPAIR_INDEX_MAGIC or size != stat.st_size or
+            mtime != stat.st_mtime_ns or
+            len(data) != KEYPAIR_INDEX_HEADER.size + 8*n_rows):
+        return None
+    offsets = array('Q')
+    offsets.frombytes(data[KEYPAIR_INDEX_HEADER.size:])
+    return offsets
+
+def find_keypair_rows(file, pairs):
+    """Looks up rows of key pairs in a key pair input file by its index.
+
+    The index is stored next to the input file and built if missing or
+    outdated. For each first key of the pairs, the first row starting with
+    it is found by binary search, and rows are read from there on as long
+    as they start with that key.
+
+    Args:
+        file: Name of csv input file holding key pair data.
+        pairs: Set of search phrases "key1 key2" to look up.
+
+    Returns:
+        A tuple of the header and the list of rows (lists of cells) of all
+        found search phrases.
+    """
+    stat = os.stat(file)
+    index_file = file + ".kpi"
+    offsets = read_keypair_index(index_file, stat)
+    if offsets is None:
+        offsets = build_keypair_index(file, index_file, stat)
+
+    if not stat.st_size:
+        raise ValueError("Empty key pair file %s" % file)
+    with open(file, 'rb') as csvfile:
+        data = mmap.mmap(csvfile.fileno(), 0, access=mmap.ACCESS_READ)
+
+    with data:
+        end = data.find(b'\n')
+        header = split_keydata_line(data[:end + 1 if end >= 0 else
+            len(data)].decode('utf-8-sig'))
+        key = header.index("key")
+
+        def get_line(i):
+            start = offsets[i]
+            end = data.find(b'\n', start)
+            return data[start:end + 1 if end >= 0 else len(data)]
+
+        def get_key(line):
+            if b'|' in line:
+                return split_keydata_line(line.decode('utf-8'))[key].encode(
+                    'utf-8')
+            return line.split(b',', key + 1)[key]
+
+        rows = []
+        found = set()
+        prefixes = sorted(set(pair.split(" ", 1)[0] + " " for pair in pairs))
+        for prefix in prefixes:
+            prefix = prefix.encode('utf-8')
+
+            # First row with key >= prefix
+            (low, high) = (0, len(offsets))
+            while low < high:
+                middle = (low + high) // 2
+                if get_key(get_line(middle)) < prefix:
+                    low = middle + 1
+                else:
+                    high = middle
+
+            for i in range(low, len(offsets)):
+                line = get_line(i)
+                row_key = get_key(line)
+                if not row_key.startswith(prefix):
+                    break
+                if row_key.decode('utf-8') in pairs and i not in found:
+                    found.add(i)
+                    rows.append(split_keydata_line(line.decode('utf-8')))
+
+    return (header, rows)
+
+def read_in_grouped_keydata(file):
+    """Read in keyword data of several locales and apps from input file.
+
+    Same as read_in_keydata, but rows are grouped by the lang column and an
+    optional app column of the input file. A group with malformed rows is
+    skipped and reported as erroneous, without affecting other groups.
+
+    Args:
+        file: Name of csv input file holding all keyword data.
+
+    Returns:
+        A tuple (groups, errors) of a dict of KeyDataStore objects and a dict
+        of error messages, both by (lang, app) tuples. App is empty if the
+        input file has no app column.
+    """
+
+    groups = {}
+    errors = {}
+
+    try:
+        csvfile = open_keydata_file(file)
+    except IOError as e:
+        print('Exception: %s' % e)
+        return (groups, errors)
+
+    with csvfile:
+        csvreader = csv.reader(csvfile, delimiter=',', quotechar='|')
+
+        # Resolve column positions from header
+        file_header = next(csvreader, [])
+        try:
+            columns = [file_header.index(name) for name in ("key", "traffic",
+                "iphone_diff", "iphone_apps", "ipad_diff", "ipad_apps")]
+        except ValueError as e:
+            print('Exception: %s' % e)
+            return (groups, errors)
+        lang = file_header.index("lang") if "lang" in file_header else None
+        app = file_header.index("app") if "app" in file_header else None
+
+        # Collect columns of each group
+        group_columns = {}
+        for (line, row) in enumerate(csvreader, 2):
+            group = (row[lang] if lang is not None and lang < len(row) else "",
+                row[app] if app is not None and app < len(row) else "")
+            if group in errors:
+                continue
+            if group not in group_columns:
+                group_columns[group] = ([], [array('d') for i in range(5)])
+            (keys, metrics) = group_columns[group]
+            try:
+                values = [float(row[column]) for column in columns[1:]]
+                keys.append(row[columns[0]])
+            except (ValueError, IndexError) as e:
+                errors[group] = "Line %d: %s" % (line, e)
+                del group_columns[group]
+                continue
+            for (metric, value) in zip(metrics, values):
+                metric.append(value)
+
+    for (group, (keys, metrics)) in group_columns.items():
+        groups[group] = KeyDataStore()
+        groups[group].extend(keys, *metrics)
+
+    return (groups, errors)
+
+def read_in_manifest(file):
+    """Read in manifest of key and keypair input files.
+
+    The manifest is a csv file with columns key_data and keypair_data holding
+    the input file names of each selection and optional columns lang and app.
+    Groups without lang or app column are named by their key_data file.
+
+    Returns:
+        A list of ((lang, app), key_data file, keypair_data file) tuples.
+    """
+    entries = []
+    try:
+        with open(file, 'r', newline='', encoding='utf-8-sig') as csvfile:
+            for row in csv.DictReader(csvfile):
+                group = (row.get("lang") or "",
+                    row.get("app") or row["key_data"])
+                entries.append((group, row["key_data"],
+                    row.get("keypair_data") or ""))
+    except (IOError, KeyError) as e:
+        print('Exception: %s' % e)
+    return entries
+
+# Buffer size used to read input files
+READ_BUFFER_SIZE = 1 << 20
+
+# Snapshot header: magic, input file size and mtime, number of keys, byte 
+# length of keys
+SNAPSHOT_MAGIC = b'KDS1' + sys.byteorder[0].encode() + b'   '
+SNAPSHOT_HEADER = struct.Struct('8sQqQQ')
+
+# Float64 columns stored in a snapshot
+SNAPSHOT_COLUMNS = ('traffic', 'iphone_diff', 'iphone_apps', 'ipad_diff',
+    'ipad_apps', 'avg_diff', 'avg_apps', 'key_len')
+
+def write_keydata_snapshot(file, key_data, stat):
+    """Writes binary snapshot of keyword data.
+
+    The snapshot holds a header, all float64 metric columns (8 byte aligned,
+    so they can be memory mapped) and the utf-8 encoded keys separated by
+    newlines. The snapshot is written to a temporary file first and then
+    replaces the snapshot file, so other processes never read a partially
+    written snapshot.
+
+    Args:
+        file: Name of snapshot file.
+        key_data: KeyDataStore object to store.
+        stat: os.stat_result of the input file the keyword data was read from.
+    """
+    keys = "\n".join(key_data.keys).encode('utf-8')
+    # Temporary file per process, as workers may write the same snapshot
+    tmp_file = "%s.%d.tmp" % (file, os.getpid())
+    try:
+        with open(tmp_file, 'wb') as snapshot:
+            snapshot.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, stat.st_size,
+                stat.st_mtime_ns, len(key_data.keys), len(keys)))
+            for column in SNAPSHOT_COLUMNS:
+                getattr(key_data, column).tofile(snapshot)
+            snapshot.write(keys)
+        os.replace(tmp_file, file)
+    except IOError as e:
+        print('Exception: Could not write snapshot. %s' % e)
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+
+def read_keydata_snapshot(file, stat):
+    """Reads binary snapshot of keyword data, see write_keydata_snapshot.
+
+    Args:
+        file: Name of snapshot file.
+        stat: os.stat_result of the input file the snapshot was created from.
+
+    Returns:
+        A KeyDataStore object or None if there is no valid snapshot for the 
+        input file.
+    """
+    try:
+        with open(file, 'rb') as snapshot:
+            data = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, ValueError):
+        return None
+
+    with data:
+        if len(data) < SNAPSHOT_HEADER.size:
+            return None
+        (magic, size, mtime, n_keys, keys_len) = \
+            SNAPSHOT_HEADER.unpack_from(data)
+        offset = SNAPSHOT_HEADER.size
+        if (magic != SNAPSHOT_MAGIC or size != stat.st_size or
+                mtime != stat.st_mtime_ns or len(data) != offset +
+                8 * n_keys * len(SNAPSHOT_COLUMNS) + keys_len):
+            return None
+
+        key_data = KeyDataStore()
+        with memoryview(data) as view:
+            for column in SNAPSHOT_COLUMNS:
+                getattr(key_data, column).frombytes(view[offset:offset +
+                    8*n_keys])
+                offset += 8*n_keys
+            keys = str(view[offset:offset + keys_len], 'utf-8')
+
+    key_data.keys = keys.split("\n") if n_keys else []
+    key_data.rebuild_index()
+    return key_data
+
+def calc_keylist_permutations(keys, max_keylist_len, min_keylist_len, file="",
+                              cache=None, metrics=None, writer=None):
     """Determine all possible keyword combinations.
     
     For a given set of input keywords, determines all possible keyword 
@@ -143,6 +772,12 @@ def calc_keylist_permutations(keys, max_keylist_len, min_keylist_len, file=""):
             Keyword combinations with less than min_keylist_len will be skipped.
         file: Name of output file, where list of keyword combinations will be 
             stored to (optional. If left empty, no file stored).
+        cache: KeylistCache object to read keyword combinations from or
+            store them to (optional).
+        metrics: Metrics object to record stages calc_keylist_permutations
+            and export_keylists in (optional).
+        writer: OutputWriter object to export file in the background
+            (optional, see write_output).
 
     Returns:
         A list of all possible keyword lists that do not violate the min/ max
@@ -151,57 +786,505 @@ def calc_keylist_permutations(keys, max_keylist_len, min_keylist_len, file=""):
 
     print("input keys: ", keys, "\n")
     
-    key_lists = []
-    perms = []
+    with measure_stage(metrics, 'calc_keylist_permutations'):
+        if cache is None:
+            key_lists = list(iter_keylists(keys, max_keylist_len,
+                min_keylist_len, metrics))
+        else:
+            key_lists = [decode_keylist(mask, keys) for mask in
+                cache.get_masks(keys, max_keylist_len, min_keylist_len)]
+
+    # Write unique keyword lists without sublists to csv
+    if file != "":
+        with measure_stage(metrics, 'export_keylists'):
+            write_output(file, None, key_lists,
+                "Keyword lists exported to file: %s", writer, delimiter=',',
+                quotechar='|', quoting=csv.QUOTE_MINIMAL)
+            if metrics is not None:
+                metrics.count('rows_written', len(key_lists))
+
+    return key_lists
+
+def iter_keylists(keys, max_keylist_len, min_keylist_len, metrics=None):
+    """Generate all candidate keyword lists, see calc_keylist_permutations."""
+    for mask in iter_keylist_masks(keys, max_keylist_len, min_keylist_len,
+            metrics):
+        yield decode_keylist(mask, keys)
+
+def iter_keylist_masks(keys, max_keylist_len, min_keylist_len, metrics=None,
+                       bucketed=False):
+    """Generate all candidate keyword lists as bitmasks, see encode_keylists.
+
+    Optionally counts generated and pruned keyword combinations in metrics,
+    see iter_maximal_keylist_masks. With bucketed set, combinations are
+    generated by length buckets, see iter_bucketed_keylist_masks.
+    """
 
     # Get composite key length (length of all input keys separated by a comma)
-    keylist_len = len(",".join(keys))    
+    keylist_len = len(",".join(keys))
 
     if keylist_len > max_keylist_len:
-        
-        # Create keyword combinations
-        for i in range(len(keys)+1):        
-            for c in itertools.combinations(keys, i):
-                cc = ','.join(c)
-                if len(cc) >= min_keylist_len and len(cc) <= max_keylist_len:
-                    perms.append(c)
-        
-        # Sort all permutations to delete duplicates
-        sorted_perms = [sorted(p) for p in perms]
-        
-        # Delete duplicates
-        unique_perms = [list(x) for x in set(tuple(x) for x in sorted_perms)]
-        
-        # Delete all permutation subsets, e.g. "add,math" is a subset of 
-        # "add,math,calculate"
-        no_subset_perms = unique_perms[:]
-        for i,cur_perm in enumerate(unique_perms):
-            for j,next_perm in enumerate(unique_perms):
-                if set(cur_perm).issubset(set(next_perm)) and i!=j:
-                    no_subset_perms.remove(cur_perm)
-                    break
-        
-        key_lists = no_subset_perms[:]
-
+        # Create keyword combinations without sublists, e.g. "add,math" is a
+        # subset of "add,math,calculate"
+        if bucketed:
+            yield from iter_bucketed_keylist_masks(keys, max_keylist_len,
+                min_keylist_len, metrics)
+        else:
+            yield from iter_maximal_keylist_masks(keys, max_keylist_len,
+                min_keylist_len, metrics=metrics)
     else:
         # Include all input keys, if composite key length below max key length
         print("Input keys below max char length. Including all keys.")
-        key_lists = [keys[:]]
+        if metrics is not None:
+            metrics.count('combinations_generated')
+        yield (1 << len(keys)) - 1
 
-    # Write unique keyword lists without sublists to csv
-    if file != "":
-        with open(file, 'w', newline='', encoding='utf8') as csvfile:
-            csvwriter = csv.writer(csvfile, delimiter=',', 
-                quotechar='|', quoting=csv.QUOTE_MINIMAL)    
-            for key_list in key_lists:
-                csvwriter.writerow(key_list)        
-        print("Keyword lists exported to file: %s" % file)
+def iter_maximal_keylist_masks(keys, max_keylist_len, min_keylist_len,
+                               prefix=None, metrics=None):
+    """Generate all keyword combinations that are no subset of another one.
 
-    return key_lists
+    Builds keyword combinations depth-first and yields only maximal ones,
+    i.e. combinations of at least min_keylist_len chars, to which no unused
+    key can be added without exceeding max_keylist_len chars. Any valid
+    combination with a key to spare is a subset of another valid combination
+    and skipped during construction, as well as any branch that can't reach
+    min_keylist_len or a maximal combination anymore.
+
+    Args:
+        keys: List of input keywords to determine keyword combinations.
+        max_keylist_len: Maximum allowed char length of a keyword combination.
+        min_keylist_len: Minimum allowed char length of a keyword combination.
+        prefix: Tuple (depth, mask) to only generate combinations, that
+            include exactly the keys of mask out of the first depth keys
+            (optional, see get_prefix_shards).
+        metrics: Metrics object to count generated combinations and pruned
+            branches, i.e. partial combinations rejected by length and
+            partial combinations only leading to subsets (optional).
+
+    Yields:
+        Keyword combinations as bitmasks over keys, see encode_keylists.
+    """
+
+    n = len(keys)
+
+    # Every key takes its length plus a separating comma, hence the budget of
+    # a keylist is max_keylist_len + 1 chars
+    costs = [len(key) + 1 for key in keys]
+    budget = max_keylist_len + 1
+
+    tail_costs = [0] * (n+1)
+    for i in range(n-1, -1, -1):
+        tail_costs[i] = tail_costs[i+1] + costs[i]
+
+    # Number of generated combinations, branches rejected by length and
+    # branches removed as subsets
+    counts = [0, 0, 0]
+
+    def search(i, mask, used, min_excluded):
+        # Keylist can't reach min length or stay without sublists, i.e. the
+        # shortest excluded key would still fit in
+        if max(used + tail_costs[i] - 1, 0) < min_keylist_len:
+            counts[1] += 1
+            return
+        if used + tail_costs[i] + min_excluded <= budget:
+            counts[2] += 1
+            return
+
+        if i == n:
+            counts[0] += 1
+            yield mask
+            return
+
+        if used + costs[i] <= budget:
+            yield from search(i+1, mask | (1 << i), used + costs[i],
+                min_excluded)
+        else:
+            counts[1] += 1
+
+        yield from search(i+1, mask, used, min(min_excluded, costs[i]))
+
+    try:
+        if prefix is None:
+            yield from search(0, 0, 0, budget + 1)
+        else:
+            (depth, mask) = prefix
+            used = sum(costs[i] for i in range(depth) if mask >> i & 1)
+            min_excluded = min([costs[i] for i in range(depth)
+                if not mask >> i & 1], default=budget + 1)
+            if used <= budget:
+                yield from search(depth, mask, used, min_excluded)
+    finally:
+        if metrics is not None:
+            metrics.add_counters({'combinations_generated': counts[0],
+                'rejected_by_length': counts[1],
+                'removed_as_subsets': counts[2]})
+
+def get_length_buckets(keys):
+    """Groups input keywords by length.
+
+    Returns:
+        A list of (cost, positions) tuples in ascending order of cost, where
+        cost is the length plus a separating comma of the keys at positions.
+    """
+    buckets = {}
+    for (i, key) in enumerate(keys):
+        buckets.setdefault(len(key) + 1, []).append(i)
+    return sorted(buckets.items())
+
+def count_keylists(keys, max_keylist_len, min_keylist_len):
+    """Counts all candidate keyword lists without generating them.
+
+    Validity of a keyword combination only depends on its summed key costs
+    (length plus comma) and the cost of the shortest unused key, hence all
+    combinations taking the same number of keys of each length bucket are
+    either valid or not. The number of combinations of each total cost and
+    shortest unused key cost is counted bucket by bucket (taking k out of m
+    keys of a bucket in comb(m, k) ways), so counting takes
+    O(buckets * budget * keys) steps, however many candidates there are.
+
+    Returns:
+        The number of keylists iter_keylist_masks generates.
+    """
+
+    if len(",".join(keys)) <= max_keylist_len:
+        # All input keys fit into one keylist
+        return 1
+
+    budget = max_keylist_len + 1
+
+    # Number of combinations by (used cost, shortest unused key cost)
+    counts = {(0, budget + 1): 1}
+    for (cost, positions) in get_length_buckets(keys):
+        m = len(positions)
+        new_counts = collections.defaultdict(int)
+        for ((used, min_excluded), count) in counts.items():
+            for k in range(min(m, (budget - used) // cost) + 1):
+                new_counts[(used + k*cost, min_excluded if k == m else
+                    min(min_excluded, cost))] += count * math.comb(m, k)
+        counts = new_counts
+
+    return sum(count for ((used, min_excluded), count) in counts.items()
+        if used + min_excluded > budget and max(used - 1, 0) >=
+        min_keylist_len)
+
+def iter_bucketed_keylist_masks(keys, max_keylist_len, min_keylist_len,
+                                metrics=None):
+    """Generate all keyword combinations that are no subset of another one.
+
+    Generates the same combinations as iter_maximal_keylist_masks, but
+    searches over the number of keys taken of each length bucket (see
+    count_keylists) instead of over single keys. Each valid choice of
+    numbers yields the product of all combinations of that many keys within
+    each bucket, all of them valid, so no combination is checked one at a
+    time. Combinations are generated bucket choice by bucket choice, i.e. in
+    a different order than iter_maximal_keylist_masks.
+
+    Args:
+        keys: List of input keywords to determine keyword combinations.
+        max_keylist_len: Maximum allowed char length of a keyword combination.
+        min_keylist_len: Minimum allowed char length of a keyword combination.
+        metrics: Metrics object to count generated combinations and pruned
+            bucket choices, see iter_maximal_keylist_masks (optional).
+
+    Yields:
+        Keyword combinations as bitmasks over keys, see encode_keylists.
+    """
+
+    buckets = get_length_buckets(keys)
+    n = len(buckets)
+    budget = max_keylist_len + 1
+
+    tail_costs = [0] * (n+1)
+    for b in range(n-1, -1, -1):
+        tail_costs[b] = tail_costs[b+1] + buckets[b][0] * len(buckets[b][1])
+
+    # Bitmasks of all combinations of k keys of each bucket, built lazily
+    bucket_masks = [{} for b in range(n)]
+
+    def get_masks(b, k):
+        masks = bucket_masks[b].get(k)
+        if masks is None:
+            masks = bucket_masks[b][k] = [sum(1 << i for i in combination)
+                for combination in itertools.combinations(buckets[b][1], k)]
+        return masks
+
+    # Number of generated combinations, bucket choices rejected by length and
+    # bucket choices removed as subsets
+    counts = [0, 0, 0]
+
+    def search(b, chosen, used, min_excluded):
+        # Same pruning as iter_maximal_keylist_masks, see there
+        if max(used + tail_costs[b] - 1, 0) < min_keylist_len:
+            counts[1] += 1
+            return
+        if used + tail_costs[b] + min_excluded <= budget:
+            counts[2] += 1
+            return
+
+        if b == n:
+            product = [get_masks(c, k) for (c, k) in enumerate(chosen)]
+            counts[0] += math.prod(map(len, product))
+            yield from map(sum, itertools.product(*product))
+            return
+
+        (cost, positions) = buckets[b]
+        m = len(positions)
+        for k in range(m, -1, -1):
+            if used + k*cost > budget:
+                counts[1] += 1
+                continue
+            yield from search(b+1, chosen + [k], used + k*cost,
+                min_excluded if k == m else min(min_excluded, cost))
+
+    try:
+        yield from search(0, [], 0, budget + 1)
+    finally:
+        if metrics is not None:
+            metrics.add_counters({'combinations_generated': counts[0],
+                'rejected_by_length': counts[1],
+                'removed_as_subsets': counts[2]})
+
+def get_prefix_shards(n_keys, n_shards):
+    """Splits the keyword combination space into disjoint shards.
+
+    Each shard fixes which of the first depth keys are included, with depth
+    chosen to get at least n_shards shards. Shards are returned in the order
+    iter_maximal_keylist_masks visits them, i.e. generating all shards one
+    after another yields the same sequence as generating all combinations.
+
+    Returns:
+        A list of prefixes (depth, mask), see iter_maximal_keylist_masks.
+    """
+    depth = 0
+    while (1 << depth) < n_shards and depth < n_keys:
+        depth += 1
+
+    # Keys are included before they are excluded, hence shard p includes key
+    # i if bit depth-1-i of p is not set
+    return [(depth, sum(1 << i for i in range(depth)
+        if not p >> (depth-1-i) & 1)) for p in range(1 << depth)]
+
+def new_mask_array(keys, masks=()):
+    """Returns a compact uint64 array of bitmasks (a list for > 64 keys)."""
+    if len(keys) <= 64:
+        return array('Q', masks)
+    else:
+        return list(masks)
+
+def encode_keylists(key_lists, keys):
+    """Encodes keyword lists as bitmasks over the input keywords.
+
+    Bit i of a bitmask is set if the keyword list includes keys[i].
+
+    Args:
+        key_lists: A list of keyword lists.
+        keys: List of input keywords.
+
+    Returns:
+        An array of bitmasks, see new_mask_array.
+    """
+    bits = {}
+    for i, key in enumerate(keys):
+        bits.setdefault(key, 1 << i)
+    return new_mask_array(keys, [sum(bits[key] for key in set(key_list))
+        for key_list in key_lists])
+
+def decode_keylist(mask, keys):
+    """Returns the keyword list of a bitmask, see encode_keylists."""
+    key_list = []
+    while mask:
+        low = mask & -mask
+        key_list.append(keys[low.bit_length() - 1])
+        mask ^= low
+    return key_list
+
+def remap_masks(masks, from_keys, to_keys):
+    """Maps bitmasks over from_keys to bitmasks over to_keys.
+
+    Both lists have to hold the same keys, in any order.
+    """
+    positions = {}
+    for i, key in enumerate(to_keys):
+        positions.setdefault(key, []).append(i)
+    bits = [1 << positions[key].pop(0) for key in from_keys]
+
+    # Mapped bits of each byte of a bitmask
+    tables = []
+    for start in range(0, len(bits), 8):
+        table = [0] * 256
+        for b in range(1, 1 << len(bits[start:start + 8])):
+            low = b & -b
+            table[b] = table[b ^ low] | bits[start + low.bit_length() - 1]
+        tables.append(table)
+
+    return new_mask_array(to_keys, [sum(table[mask >> 8*i & 255] for
+        (i, table) in enumerate(tables)) for mask in masks])
+
+class KeylistCache(object):
+    """Object to memoize candidate keyword lists on disk.
+
+    Candidate keyword lists only depend on the input keys and the length
+    limits, so they are stored as bitmasks in one binary file per (sorted
+    keys, max_keylist_len, min_keylist_len), named after the sha256 hash of
+    it. Files are evicted least recently used first once all files exceed
+    max_size bytes.
+
+    Attributes:
+        directory: Name of cache directory.
+        max_size: Maximum total size of cache files in bytes.
+        stats: Dict of number of hits, misses and evictions.
+    """
+
+    # Header: magic, number of keys, number of keylists, max/min keylist
+    # length, byte length of keys
+    MAGIC = b'KLC1' + sys.byteorder[0].encode() + b'   '
+    HEADER = struct.Struct('8sQQqqQ')
+
+    def __init__(self, directory, max_size=256 << 20):
+        self.directory = directory
+        self.max_size = max_size
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        os.makedirs(directory, exist_ok=True)
+
+    def get_file(self, keys, max_keylist_len, min_keylist_len):
+        """Returns the name of the cache file of keys and length limits."""
+        digest = hashlib.sha256(("%d\n%d\n" % (max_keylist_len,
+            min_keylist_len) + "\n".join(sorted(keys))).encode('utf-8'))
+        return os.path.join(self.directory, digest.hexdigest() + '.klc')
+
+    def get_masks(self, keys, max_keylist_len, min_keylist_len):
+        """Returns all candidate keylists of keys as bitmasks.
+
+        Reads keylists from cache or, on a miss, enumerates and stores them.
+        See iter_keylist_masks and encode_keylists.
+        """
+        masks = self.load(keys, max_keylist_len, min_keylist_len)
+        if masks is None:
+            self.stats['misses'] += 1
+            masks = new_mask_array(keys, iter_keylist_masks(keys,
+                max_keylist_len, min_keylist_len, bucketed=True))
+            self.store(keys, max_keylist_len, min_keylist_len, masks)
+        else:
+            self.stats['hits'] += 1
+        return masks
+
+    def load(self, keys, max_keylist_len, min_keylist_len):
+        """Reads keylists from cache, returns None if not cached."""
+        file = self.get_file(keys, max_keylist_len, min_keylist_len)
+        try:
+            with open(file, 'rb') as cache_file:
+                data = cache_file.read()
+        except IOError:
+            return None
+
+        if len(data) < self.HEADER.size:
+            return None
+        (magic, n_keys, n_masks, max_len, min_len, keys_len) = \
+            self.HEADER.unpack_from(data)
+        offset = self.HEADER.size
+        keys_end = offset + keys_len
+        words = (n_keys + 63) // 64 or 1
+        masks_start = keys_end + -keys_end % 8
+        if (magic != self.MAGIC or (max_len, min_len) != (max_keylist_len,
+                min_keylist_len) or len(data) != masks_start +
+                8*words*n_masks):
+            return None
+        cached_keys = data[offset:keys_end].decode('utf-8').split("\n") \
+            if n_keys else []
+        if sorted(cached_keys) != sorted(keys):
+            # Hash collision
+            return None
+
+        masks = array('Q')
+        masks.frombytes(data[masks_start:])
+        if words > 1:
+            masks = [sum(masks[i + w] << 64*w for w in range(words)) for i in
+                range(0, len(masks), words)]
+
+        # Mark as recently used
+        os.utime(file)
+
+        if cached_keys != list(keys):
+            masks = remap_masks(masks, cached_keys, keys)
+        return masks
+
+    def store(self, keys, max_keylist_len, min_keylist_len, masks):
+        """Writes keylists to cache and evicts least recently used files."""
+        file = self.get_file(keys, max_keylist_len, min_keylist_len)
+        keys_data = "\n".join(keys).encode('utf-8')
+        words = (len(keys) + 63) // 64 or 1
+        if words > 1:
+            masks = array('Q', [mask >> 64*w & 0xFFFFFFFFFFFFFFFF for mask in
+                masks for w in range(words)])
+        try:
+            with open(file + '.tmp', 'wb') as cache_file:
+                cache_file.write(self.HEADER.pack(self.MAGIC, len(keys),
+                    len(masks) // words, max_keylist_len, min_keylist_len,
+                    len(keys_data)))
+                cache_file.write(keys_data)
+                cache_file.write(b'\0' * (-cache_file.tell() % 8))
+                masks.tofile(cache_file)
+            os.replace(file + '.tmp', file)
+        except IOError as e:
+            print('Exception: Could not write keylist cache. %s' % e)
+            return
+        self.evict()
+
+    def evict(self):
+        """Removes least recently used files until within max_size."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.klc'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        entries.sort()
+
+        total_size = sum(size for (mtime, size, path) in entries)
+        for (mtime, size, path) in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size -= size
+            self.stats['evictions'] += 1
+
+    def save_stats(self):
+        """Adds stats of this session to the totals in the cache directory.
+
+        Returns:
+            A dict of total number of hits, misses and evictions.
+        """
+        file = os.path.join(self.directory, 'stats.json')
+        try:
+            with open(file, 'r') as stats_file:
+                totals = json.load(stats_file)
+        except (IOError, ValueError):
+            totals = {}
+        for name, count in self.stats.items():
+            totals[name] = totals.get(name, 0) + count
+        try:
+            with open(file, 'w') as stats_file:
+                json.dump(totals, stats_file)
+        except IOError as e:
+            print('Exception: Could not write cache stats. %s' % e)
+        return totals
+
+def get_keylist_masks(keys, max_keylist_len, min_keylist_len, cache=None):
+    """Returns all candidate keylists as bitmasks, from cache if given.
+
+    Keylists are generated by length buckets, see iter_bucketed_keylist_masks.
+    """
+    if cache is None:
+        return new_mask_array(keys, iter_keylist_masks(keys, max_keylist_len,
+            min_keylist_len, bucketed=True))
+    return cache.get_masks(keys, max_keylist_len, min_keylist_len)
 
 # Calculate individual key scores as weighted sum over relevant factors
 # factors: difficulty, traffic, number of apps, key length
-def calc_key_scores(key_data, w_factors, apps_base, keylen_base, file=""):
+def calc_key_scores(key_data, w_factors, apps_base, keylen_base, file="",
+                    writer=None):
     """Calculate individual keyword score for all input keywords.
     
     Calculates keyword score as the weighted sum over all keyword metrics, 
@@ -215,6 +1298,8 @@ def calc_key_scores(key_data, w_factors, apps_base, keylen_base, file=""):
         apps_base: Integer value used to normalize key metric number of apps.
         keylen_base: Integer value used to normalize keyword length metric.
         file: Name of output file (optional. If left empty, no file stored).
+        writer: OutputWriter object to export file in the background
+            (optional, see write_output).
 
     Returns:
         A list of scores for all input keywords.
@@ -222,55 +1307,72 @@ def calc_key_scores(key_data, w_factors, apps_base, keylen_base, file=""):
 
     w_sum = (w_factors['w_diff'] + w_factors['w_traffic'] + 
         w_factors['w_apps'] + w_factors['w_keylen'])
-    if (w_sum != 1):
+    if not math.isclose(w_sum, 1):
         print("Error: Factor weights don't add up to 100%.")
         return []
 
+    w_diff = w_factors['w_diff']
+    w_traffic = w_factors['w_traffic']
+    w_apps = w_factors['w_apps']
+    w_keylen = w_factors['w_keylen']
+
     # Reverse difficulty score to be in score range [0=worst, 10=best]. Scraped
     # values are in reverse order [0=best, 10=worst]
-    norm_diff = [10 - diff for diff in key_data.avg_diff]
-    norm_traffic = key_data.traffic[:]
+    norm_diff = reverse_column(key_data.avg_diff)
+    norm_traffic = key_data.traffic
 
     # Linearize number of apps to be in score range [0,10]. Keys with number of 
     # apps above twice the apps_base receive a score of 0.
-    norm_apps = [10 - min(apps/(apps_base*2) * 10, 10) 
-        for apps in  key_data.avg_apps]
+    norm_apps = normalize_column(key_data.avg_apps, apps_base)
 
     # Linearize keyword length to be in range [0,10]. Any key with key length 
     # above twice the keylen_base will receive 0 score.
-    norm_keylen = [10 - min(key_len/(keylen_base*2) * 10, 10) 
-        for key_len in key_data.key_len]
-
-    # Calculate keyword score
-    for i in range(len(key_data.keys)):
-        score = (w_factors['w_diff'] * norm_diff[i] + 
-            w_factors['w_traffic'] + norm_traffic[i] +
-            w_factors['w_apps'] * norm_apps[i] +
-            w_factors['w_keylen'] * norm_keylen[i])
-        key_data.scores.append(score)
-
+    norm_keylen = normalize_column(key_data.key_len, keylen_base)
+
+    # Calculate keyword scores, replacing any previous scores. With numpy as
+    # whole-column operations, otherwise element by element
+    if numpy is not None:
+        key_data.scores = array('d', (w_diff * numpy.frombuffer(norm_diff) +
+            w_traffic + numpy.frombuffer(norm_traffic) + w_apps *
+            numpy.frombuffer(norm_apps) + w_keylen *
+            numpy.frombuffer(norm_keylen)).tobytes())
+    else:
+        key_data.scores = array('d', [w_diff * diff + w_traffic + traffic +
+            w_apps * apps + w_keylen * key_len for (diff, traffic, apps,
+            key_len) in zip(norm_diff, norm_traffic, norm_apps, norm_keylen)])
 
     if file != "":
         # write values to csv
-        with open(file, 'w', newline='', encoding='utf8') as csvfile:
-            csvwriter = csv.writer(csvfile, delimiter=',', quoting=csv.QUOTE_NONE)
-
-            csvwriter.writerow(['key', 'score', 'avg_difficulty', 'traffic', 
-                'avg_apps', 'key_len', 'norm_diff', 'norm_traffic', 'norm_apps', 
-                'norm_keylen'])
-
-            for i in range(len(key_data.keys)):
-                row_out = [key_data.keys[i], key_data.scores[i], 
-                    key_data.avg_diff[i], key_data.traffic[i], key_data.avg_apps[i], 
-                    key_data.key_len[i], norm_diff[i], norm_traffic[i], 
-                    norm_apps[i], norm_keylen[i]]
-                csvwriter.writerow(row_out)
-            
-        print("Key scores exported to file: %s" % file)
+        rows = ([key, score, diff, traffic, apps, int(key_len), n_diff,
+            n_traffic, n_apps, n_keylen] for (key, score, diff, traffic, apps,
+            key_len, n_diff, n_traffic, n_apps, n_keylen) in zip(
+            key_data.keys, key_data.scores, key_data.avg_diff,
+            key_data.traffic, key_data.avg_apps, key_data.key_len, norm_diff,
+            norm_traffic, norm_apps, norm_keylen))
+        write_output(file, ['key', 'score', 'avg_difficulty', 'traffic', 
+            'avg_apps', 'key_len', 'norm_diff', 'norm_traffic', 'norm_apps', 
+            'norm_keylen'], rows, "Key scores exported to file: %s", writer,
+            delimiter=',', quoting=csv.QUOTE_NONE)
 
     return key_data.scores
 
-def calc_keylist_scores(key_lists, key_data, max_keylist_len, file=""):
+def normalize_column(column, base):
+    """Linearizes a metric column to score range [10=zero, 0=twice base]."""
+    scale = base*2
+    if numpy is not None:
+        return array('d', (10 - numpy.minimum(numpy.frombuffer(column) /
+            scale * 10, 10)).tobytes())
+    return array('d', [10 - value/scale * 10 if value <= scale else 0.0
+        for value in column])
+
+def reverse_column(column):
+    """Reverses a difficulty column to score range [0=worst, 10=best]."""
+    if numpy is not None:
+        return array('d', (10 - numpy.frombuffer(column)).tobytes())
+    return array('d', [10 - value for value in column])
+
+def calc_keylist_scores(key_lists, key_data, max_keylist_len, file="",
+                        writer=None):
     """Calculate keylist scores.
 
     Calculates score of each input keyword list as the sum over all individual
@@ -284,6 +1386,8 @@ def calc_keylist_scores(key_lists, key_data, max_keylist_len, file=""):
         key_data: KeyDataStore object containing all individual keyword scores.
         max_keylist_len: Maximum allowed char length of a keyword list.
         file: Name of output file (optional. If left empty, no file stored).
+        writer: OutputWriter object to export file in the background
+            (optional, see write_output).
 
     Returns:
         A list of scores for all input keywords.
@@ -317,28 +1421,27 @@ def calc_keylist_scores(key_lists, key_data, max_keylist_len, file=""):
 
     if file != "":            
         # write to csv
-        with open(file, 'w', newline='', encoding='utf8') as csvfile:
-            csvwriter = csv.writer(csvfile, delimiter=';', quoting=csv.QUOTE_NONE)
-        
-            csvwriter.writerow(['keylist', 'score', 'norm_score', 'max_score', 
-                'length', 'words'])    
+        def get_rows():
             for i in range(len(key_lists)):
                 keylist = ",".join(key_lists[i])
-                row_out = [keylist, keylist_scores[i], norm_scores[i], max_score,
+                yield [keylist, keylist_scores[i], norm_scores[i], max_score,
                     len(keylist), len(key_lists[i])]
-                csvwriter.writerow(row_out)
 
-        print("Keylist scores exported to file: %s" % file)
+        write_output(file, ['keylist', 'score', 'norm_score', 'max_score', 
+            'length', 'words'], get_rows(),
+            "Keylist scores exported to file: %s", writer, delimiter=';',
+            quoting=csv.QUOTE_NONE)
 
     return norm_scores
 
 def get_key_score(key, key_data):
     """Returns score of a keyword."""
-    try:
-        return key_data.scores[key_data.keys.index(key)]
-    except ValueError as e:
-        print("Error: No score for key '%s'. Reason: %s." % (str(key), str(e)))
+    i = key_data.index.get(key)
+    if i is None:
+        print("Error: No score for key '%s'. Reason: '%s' is not in list." 
+            % (str(key), str(key)))
         return -99
+    return key_data.scores[i]
 
 def get_best_keylist(key_lists, keylist_scores):
     """Returns highest scoring keylist."""
@@ -364,7 +1467,8 @@ def get_keypair_combinations(keys):
     """
     return [" ".join(x) for x in itertools.permutations(keys, 2)]
 
-def calc_keypair_scores(key_lists, keypair_data, max_keylist_len, file=""):
+def calc_keypair_scores(key_lists, keypair_data, max_keylist_len, file="",
+                        writer=None):
     """Calculates additional score for using key pairs as search phrase.
 
     Assume two keylists k1, k2, with same keylist score. Further assume that k1 
@@ -380,6 +1484,8 @@ def calc_keypair_scores(key_lists, keypair_data, max_keylist_len, file=""):
             relevant dual keyword serach phrases.
         max_keylist_len: Maximum allowed char length of a keyword list.
         file: Name of output file (optional. If left empty, no file stored).
+        writer: OutputWriter object to export file in the background
+            (optional, see write_output).
 
     Returns:
         A list of scores for all dual keyword permutations for each input
@@ -418,70 +1524,2239 @@ def calc_keypair_scores(key_lists, keypair_data, max_keylist_len, file=""):
 
     # Write to csv
     if file != "":
-        with open(file, 'w', newline='', encoding='utf8') as csvfile:
-            csvwriter = csv.writer(csvfile, delimiter=';', quoting=csv.QUOTE_NONE)
-        
-            csvwriter.writerow(['keylist', 'score', 'norm_score', 'max_score', 
-                'length', 'words', 'permutations'])
+        def get_rows():
             for i in range(len(key_lists)):
                 keylist = ",".join(key_lists[i])
-                row_out = [keylist, scores[i], norm_scores[i], max_score,
+                yield [keylist, scores[i], norm_scores[i], max_score,
                     len(keylist), len(key_lists[i]), keylist_perms[i]]
-                csvwriter.writerow(row_out)
 
-        print("Keylist keypair scores exported to file: %s" % file)
+        write_output(file, ['keylist', 'score', 'norm_score', 'max_score', 
+            'length', 'words', 'permutations'], get_rows(),
+            "Keylist keypair scores exported to file: %s", writer,
+            delimiter=';', quoting=csv.QUOTE_NONE)
 
     return norm_scores
 
-def process(key_data, keypair_data, include_dual_keys, max_keylist_len, 
-            min_keylist_len, w_factors, apps_base, keylen_base):
+def build_keypair_table(keys, keypair_data, scores=None):
+    """Builds the dual key score table of a set of input keywords.
+
+    Args:
+        keys: A list of input keywords.
+        keypair_data: KeyDataStore object containing all dual keyword scores.
+        scores: Column of keypair_data to use instead of the scores (optional).
+
+    Returns:
+        A tuple (scores, missing) of n x n tables, where scores[i][j] holds the
+        score of search phrase "keys[i] keys[j]" and missing[i][j] is True if
+        there is no score for that search phrase.
+    """
+
+    if scores is None:
+        scores = keypair_data.scores
+
+    n = len(keys)
+    table = [[0.0] * n for i in range(n)]
+    missing = [[False] * n for i in range(n)]
+    for i in range(n):
+        for j in range(n):
+            if i != j:
+                row = keypair_data.index.get(keys[i] + " " + keys[j])
+                if row is None:
+                    missing[i][j] = True
+                else:
+                    table[i][j] = scores[row]
 
-    # Determine keylist permutations
-    key_lists = calc_keylist_permutations(key_data.keys, max_keylist_len, 
-        min_keylist_len, 'out_keylists.csv')
+    return (table, missing)
 
-    # Calculate individual keyword scores
-    key_scores = calc_key_scores(key_data, w_factors, apps_base, 
-        keylen_base, 'out_key_scores.csv')
+def build_value_tables(key_data, keypair_data, include_dual_keys,
+                       max_keylist_len):
+    """Builds the contribution of each key and key pair to keylist scores.
 
-    # Calculate keylist scores
-    keylist_scores = calc_keylist_scores(key_lists, key_data, max_keylist_len,
-        'out_keylist_scores.csv')
+    The cumulative score of a keylist (see process) equals the sum of the key
+    values of its keys plus the pair values of all its key pairs, unless a
+    key pair has no score. In that case the pair values are replaced by
+    missing_value, the normalized keypair error score of -99.
 
-    cumulative_scores = []
+    Args:
+        key_data: KeyDataStore object containing all individual keyword scores.
+        keypair_data: KeyDataStore object containing all dual keyword scores.
+        include_dual_keys: Include score of dual key combinations.
+        max_keylist_len: Maximum allowed char length of a keyword list.
+
+    Returns:
+        A tuple (key_values, pair_values, pair_missing, missing_value), where
+        pair_values[i][j] holds the combined value of both orderings of
+        search phrase "keys[i] keys[j]" and pair_missing[i][j] is True if any
+        of them has no score.
+    """
+
+    # Weights and normalization of keylist and keypair scores, see
+    # calc_keylist_scores, calc_keypair_scores and process
+    max_keys = max_keylist_len/2
     if include_dual_keys:
-        # Calculate additional score of dual key combinations of keylist
-        keypair_scores = calc_key_scores(keypair_data, w_factors, apps_base, 
-            keylen_base, 'out_keypair_scores.csv')
-        keylist_keypair_scores = calc_keypair_scores(key_lists, keypair_data,
-            max_keylist_len, "out_keylist_keypair_scores.csv")
-            
-        # Calculate cumulative keylist scores, which equals the sum of the 
-        # individual keyword scores (twice as important) and the dual key 
-        # combination score
-        cumulative_scores = [score for score in map(lambda x,y:2/3*x + 1/3*y,
-            keylist_scores, keylist_keypair_scores)]
+        key_weight = 2/3 / (max_keylist_len/2 * 10)
+        pair_weight = 1/3 / (max_keys * (max_keys-1) * 10)
+        missing_value = 1/3 * -99 / (max_keys * (max_keys-1) * 10)
     else:
-        keylist_keypair_scores = [0 for score in keylist_scores]
-        cumulative_scores = keylist_scores[:]
+        key_weight = 1 / (max_keylist_len/2 * 10)
+        pair_weight = 0
+        missing_value = 0
 
-    with open("out_keylist_scores_cum.csv", 'w', 
-        newline='', encoding='utf8') as csvfile:
-        
-        csvwriter = csv.writer(csvfile, delimiter=';', quoting=csv.QUOTE_NONE)
-
-        csvwriter.writerow(['keylist', 'key_score', 'keypair_score',  
-        'cumulative_score', 'length', 'words'])
-        for i in range(len(key_lists)):
-            keylist = ",".join(key_lists[i])
-            row_out = [keylist, keylist_scores[i], keylist_keypair_scores[i],
-                 cumulative_scores[i], len(keylist), len(key_lists[i])]
-            csvwriter.writerow(row_out)
-
-    # Get keylist with highest score
-    (best_keylist, best_score) = get_best_keylist(key_lists, cumulative_scores)
-    print("Woohoo, the keylist (%s) has the highest score with %.2f points!\n" 
+    keys = key_data.keys
+    n = len(keys)
+    key_values = [key_weight * get_key_score(key, key_data) for key in keys]
+
+    # Combined value of both orderings of a dual key search phrase
+    pair_values = [[0.0] * n for i in range(n)]
+    pair_missing = [[False] * n for i in range(n)]
+    if include_dual_keys:
+        (keypair_scores, missing) = build_keypair_table(keys, keypair_data)
+        for i in range(n):
+            for j in range(n):
+                pair_values[i][j] = pair_weight * (
+                    keypair_scores[i][j] + keypair_scores[j][i])
+                pair_missing[i][j] = missing[i][j] or missing[j][i]
+
+    return (key_values, pair_values, pair_missing, missing_value)
+
+def find_best_keylist(key_data, keypair_data, include_dual_keys,
+                      max_keylist_len, min_keylist_len):
+    """Determine the highest scoring keylist with a branch-and-bound search.
+
+    Searches the keyword combinations depth-first instead of enumerating all
+    of them. Each branch tracks the remaining char budget and an upper bound
+    on the cumulative score it can still reach (weighted keyword scores plus
+    keypair scores, relaxed to a fractional knapsack over the remaining
+    keywords). Branches that can't beat the best keylist found so far, can't
+    reach min_keylist_len or can't end up as a keylist without sublists are
+    pruned. Yields the same keylist and score as the exhaustive search done
+    in process, i.e. only keylists that are no subset of another valid keylist
+    are considered.
+
+    Keyword scores (and keypair scores if include_dual_keys is set) have to
+    be calculated beforehand with calc_key_scores.
+
+    Args:
+        key_data: KeyDataStore object containing all individual keyword scores.
+        keypair_data: KeyDataStore object containing all dual keyword scores.
+        include_dual_keys: Include score of dual key combinations.
+        max_keylist_len: Maximum allowed char length of a keyword list.
+        min_keylist_len: Minimum allowed char length of a keyword list.
+
+    Returns:
+        A tuple (keylist, score) of the highest scoring keylist, see
+        get_best_keylist, or None if no keylist is within the length limits.
+    """
+
+    keys = key_data.keys
+
+    if len(",".join(keys)) <= max_keylist_len:
+        # Include all input keys, if composite key length below max key length
+        print("Input keys below max char length. Including all keys.")
+        return score_keylist(keys[:], key_data, keypair_data,
+            include_dual_keys, max_keylist_len)
+
+    n = len(keys)
+    (key_values, pair_values, pair_missing, missing_value) = \
+        build_value_tables(key_data, keypair_data, include_dual_keys,
+        max_keylist_len)
+
+    # Every key takes its length plus a separating comma, hence the budget of
+    # a keylist is max_keylist_len + 1 chars
+    costs = [len(key) + 1 for key in keys]
+    budget = max_keylist_len + 1
+
+    # Visit keys with the highest value per char first to find good keylists
+    # early on
+    order = sorted(range(n), key=lambda i: key_values[i]/costs[i],
+        reverse=True)
+
+    # Sum of costs and half of the pair values of all keys from position pos
+    # of the search order onwards
+    tail_costs = [0] * (n+1)
+    tail_pairs = [[0.0] * n for pos in range(n+1)]
+    for pos in range(n-1, -1, -1):
+        k = order[pos]
+        tail_costs[pos] = tail_costs[pos+1] + costs[k]
+        tail_pairs[pos] = [tail_pairs[pos+1][i] + 0.5 * max(pair_values[i][k], 0)
+            for i in range(n)]
+
+    best = [None, float("-inf")]
+
+    def upper_bound(pos, left, links, has_missing):
+        # Fractional knapsack over the remaining keys, where each key is
+        # valued with its key score, its pairs with the chosen keys and half
+        # of its pairs with all other remaining keys
+        items = []
+        for k in order[pos:]:
+            if costs[k] <= left:
+                value = key_values[k]
+                if not has_missing:
+                    value += links[k] + tail_pairs[pos][k]
+                if value > 0:
+                    items.append((value/costs[k], value, costs[k]))
+        items.sort(reverse=True)
+
+        bound = 0.0
+        for (density, value, cost) in items:
+            if cost <= left:
+                bound += value
+                left -= cost
+            else:
+                bound += density * left
+                break
+        return bound
+
+    def search(pos, chosen, used, key_value, pair_value, links, has_missing,
+               min_excluded):
+        # Keylist can't reach min length or stay without sublists, i.e. the
+        # shortest excluded key would still fit in
+        if max(used + tail_costs[pos] - 1, 0) < min_keylist_len:
+            return
+        if used + tail_costs[pos] + min_excluded <= budget:
+            return
+
+        value = key_value + (missing_value if has_missing else pair_value)
+        if pos == n:
+            if value > best[1]:
+                best[0] = chosen[:]
+                best[1] = value
+            return
+
+        if value + upper_bound(pos, budget - used, links, has_missing) <= best[1]:
+            return
+
+        k = order[pos]
+        if used + costs[k] <= budget:
+            # Include key k, add its key score and pairs with chosen keys
+            k_missing = has_missing or any(pair_missing[k][c] for c in chosen)
+            k_links = [links[i] + pair_values[i][k] for i in range(n)]
+            chosen.append(k)
+            search(pos+1, chosen, used + costs[k], key_value + key_values[k],
+                pair_value + links[k], k_links, k_missing, min_excluded)
+            chosen.pop()
+
+        # Exclude key k
+        search(pos+1, chosen, used, key_value, pair_value, links, has_missing,
+            min(min_excluded, costs[k]))
+
+    search(0, [], 0, 0.0, 0.0, [0.0] * n, False, budget + 1)
+
+    if best[0] is None:
+        print("Error: No keylist within the char length limits.")
+        return None
+
+    # Score best keylist the same way as process does
+    best_keylist = [keys[i] for i in sorted(best[0])]
+    return score_keylist(best_keylist, key_data, keypair_data,
+        include_dual_keys, max_keylist_len)
+
+class KeylistScorer(object):
+    """Object to score keyword lists encoded as bitmasks.
+
+    Keylist scores equal the product of the bitmask matrix of all keylists
+    and the keyword score vector. Each product row is evaluated with byte-wise
+    lookup tables of partial keyword score sums, one table per 8 keywords.
+    Keypair scores equal the quadratic form of a bitmask and the n x n dual
+    keyword score table, evaluated with the lookup tables of the table row of
+    each keyword in the keylist. Scores are normalized and combined the same
+    way as in process.
+
+    Attributes:
+        keys: List of input keywords, bit i of a bitmask stands for keys[i].
+        include_dual_keys: Include score of dual key combinations.
+        max_keylist_len: Maximum allowed char length of a keyword list.
+        key_scores: Score of each keyword.
+        key_tables: Lookup tables of keyword score sums.
+        missing_keys: Bitmask of keywords without score.
+        pair_rows: Combined score of both orderings of each key pair.
+        pair_tables: Lookup tables of keypair score sums for each keyword.
+        missing_pairs: Bitmask of keywords without keypair score for each
+            keyword (any ordering).
+    """
+
+    __slots__ = ('keys', 'include_dual_keys', 'max_keylist_len',
+        'key_max_score', 'pair_max_score', 'key_scores', 'key_tables',
+        'missing_keys', 'pair_rows', 'pair_tables', 'missing_pairs')
+
+    def __init__(self, key_data, keypair_data, include_dual_keys,
+                 max_keylist_len, keys=None):
+        if keys is None:
+            keys = key_data.keys
+        self.keys = keys
+        self.include_dual_keys = include_dual_keys
+        self.max_keylist_len = max_keylist_len
+
+        # Maximum scores of a keylist, see calc_keylist_scores and
+        # calc_keypair_scores
+        max_keys = max_keylist_len/2
+        self.key_max_score = max_keylist_len/2 * 10
+        self.pair_max_score = max_keys * (max_keys-1) * 10
+
+        self.key_scores = []
+        self.missing_keys = 0
+        for i, key in enumerate(keys):
+            row = key_data.index.get(key)
+            if row is None:
+                self.missing_keys |= 1 << i
+                self.key_scores.append(0.0)
+            else:
+                self.key_scores.append(key_data.scores[row])
+        self.key_tables = build_mask_tables(self.key_scores)
+
+        n = len(keys)
+        self.pair_rows = []
+        self.pair_tables = []
+        self.missing_pairs = []
+        if include_dual_keys:
+            (keypair_scores, missing) = build_keypair_table(keys,
+                keypair_data)
+            for i in range(n):
+                self.pair_rows.append([keypair_scores[i][j] +
+                    keypair_scores[j][i] for j in range(n)])
+                self.pair_tables.append(build_mask_tables(keypair_scores[i]))
+                self.missing_pairs.append(sum(1 << j for j in range(n)
+                    if missing[i][j] or missing[j][i]))
+
+    def score(self, masks):
+        """Calculates keylist scores of a batch of bitmasks.
+
+        Args:
+            masks: A sequence of bitmasks, see encode_keylists.
+
+        Returns:
+            A tuple (keylist_scores, keypair_scores, cumulative_scores) of
+            normalized score arrays, see process.
+        """
+
+        keylist_scores = array('d', bytes(8 * len(masks)))
+        keypair_scores = array('d', bytes(8 * len(masks)))
+
+        key_tables = self.key_tables
+        for n, mask in enumerate(masks):
+            if mask & self.missing_keys:
+                # Error getting key value
+                keylist_scores[n] = -99 / self.key_max_score
+                continue
+            score = 0.0
+            for table in key_tables:
+                if not mask:
+                    break
+                score += table[mask & 255]
+                mask >>= 8
+            keylist_scores[n] = score / self.key_max_score
+
+        if not self.include_dual_keys:
+            return (keylist_scores, keypair_scores, keylist_scores)
+
+        pair_tables = self.pair_tables
+        missing_pairs = self.missing_pairs
+        for n, mask in enumerate(masks):
+            score = 0.0
+            rows = mask
+            while rows:
+                low = rows & -rows
+                i = low.bit_length() - 1
+                rows ^= low
+                if mask & missing_pairs[i]:
+                    # Error getting key value
+                    score = -99
+                    break
+                cols = mask
+                for table in pair_tables[i]:
+                    if not cols:
+                        break
+                    score += table[cols & 255]
+                    cols >>= 8
+            keypair_scores[n] = score / self.pair_max_score
+
+        # Keyword scores are twice as important as dual key combination scores
+        cumulative_scores = array('d', [2/3*x + 1/3*y for (x, y) in
+            zip(keylist_scores, keypair_scores)])
+        return (keylist_scores, keypair_scores, cumulative_scores)
+
+    def cumulative_score(self, key_score, pair_score, key_missing,
+                         pair_missing):
+        """Returns the cumulative score of raw keylist and keypair scores."""
+        key_score = (-99 if key_missing else key_score) / self.key_max_score
+        if not self.include_dual_keys:
+            return key_score
+        pair_score = (-99 if pair_missing else pair_score) / self.pair_max_score
+        return 2/3*key_score + 1/3*pair_score
+
+    def iter_scores(self, masks, batch_size=4096):
+        """Scores bitmasks in batches, yields (bitmask, cumulative score)."""
+        masks = iter(masks)
+        while True:
+            batch = new_mask_array(self.keys, itertools.islice(masks,
+                batch_size))
+            if not batch:
+                return
+            yield from zip(batch, self.score(batch)[2])
+
+def iter_scored_keylist_masks(scorer, max_keylist_len, min_keylist_len,
+                              prefix=None, metrics=None):
+    """Generate all keyword combinations without sublists with their scores.
+
+    Same search as iter_maximal_keylist_masks, but keylist and keypair
+    scores are accumulated while combinations are built. Adding a key to a
+    partial combination adds its key score and the scores of the new key
+    pairs it forms with the k keys already included (both orderings, taken
+    from the pair rows of the scorer), backtracking drops them again. Hence
+    each combination is scored in O(k) without building any search phrases.
+
+    Args:
+        scorer: KeylistScorer of the input keywords.
+        max_keylist_len: Maximum allowed char length of a keyword combination.
+        min_keylist_len: Minimum allowed char length of a keyword combination.
+        prefix: Tuple (depth, mask) to only generate a shard of all
+            combinations (optional, see iter_maximal_keylist_masks).
+        metrics: Metrics object to count generated combinations, pruned
+            branches (see iter_maximal_keylist_masks) and the keyword and key
+            pair score lookups of the generated combinations (optional, see
+            count_score_lookups).
+
+    Yields:
+        Tuples (bitmask, cumulative score), see KeylistScorer.
+    """
+
+    keys = scorer.keys
+    n = len(keys)
+    key_scores = scorer.key_scores
+    pair_rows = scorer.pair_rows
+    missing_pairs = scorer.missing_pairs
+    missing_keys = scorer.missing_keys
+    include_dual_keys = scorer.include_dual_keys
+    cumulative_score = scorer.cumulative_score
+
+    costs = [len(key) + 1 for key in keys]
+    budget = max_keylist_len + 1
+
+    tail_costs = [0] * (n+1)
+    for i in range(n-1, -1, -1):
+        tail_costs[i] = tail_costs[i+1] + costs[i]
+
+    chosen = []
+
+    # Number of generated combinations, branches rejected by length, branches
+    # removed as subsets and score lookups
+    counts = [0, 0, 0, 0]
+
+    def search(i, mask, used, min_excluded, key_score, pair_score,
+               pair_missing):
+        # Keylist can't reach min length or stay without sublists, i.e. the
+        # shortest excluded key would still fit in
+        if max(used + tail_costs[i] - 1, 0) < min_keylist_len:
+            counts[1] += 1
+            return
+        if used + tail_costs[i] + min_excluded <= budget:
+            counts[2] += 1
+            return
+
+        if i == n:
+            k = len(chosen)
+            counts[0] += 1
+            counts[3] += k + k*(k-1) if include_dual_keys else k
+            yield (mask, cumulative_score(key_score, pair_score,
+                mask & missing_keys, pair_missing))
+            return
+
+        if used + costs[i] <= budget:
+            (i_pair_score, i_pair_missing) = (pair_score, pair_missing)
+            if include_dual_keys:
+                row = pair_rows[i]
+                for j in chosen:
+                    i_pair_score += row[j]
+                i_pair_missing = pair_missing or bool(mask & missing_pairs[i])
+            chosen.append(i)
+            yield from search(i+1, mask | (1 << i), used + costs[i],
+                min_excluded, key_score + key_scores[i], i_pair_score,
+                i_pair_missing)
+            chosen.pop()
+        else:
+            counts[1] += 1
+
+        yield from search(i+1, mask, used, min(min_excluded, costs[i]),
+            key_score, pair_score, pair_missing)
+
+    try:
+        if prefix is None:
+            yield from search(0, 0, 0, budget + 1, 0.0, 0.0, False)
+            return
+
+        # Accumulate scores of the prefix keys in the order search adds them.
+        # Shards sharing a branch pruned within the prefix count it only
+        # once, in the shard including all keys after the branch point, so
+        # counts of all shards add up to those of the serial search
+        (depth, prefix_mask) = prefix
+        (mask, used, min_excluded) = (0, 0, budget + 1)
+        (key_score, pair_score, pair_missing) = (0.0, 0.0, False)
+        for i in range(depth):
+            first = prefix_mask >> i == (1 << depth - i) - 1
+            if max(used + tail_costs[i] - 1, 0) < min_keylist_len:
+                counts[1] += first
+                return
+            if used + tail_costs[i] + min_excluded <= budget:
+                counts[2] += first
+                return
+            if prefix_mask >> i & 1:
+                if used + costs[i] > budget:
+                    counts[1] += first
+                    return
+                if include_dual_keys:
+                    for j in chosen:
+                        pair_score += pair_rows[i][j]
+                    pair_missing = pair_missing or bool(mask &
+                        missing_pairs[i])
+                chosen.append(i)
+                mask |= 1 << i
+                used += costs[i]
+                key_score += key_scores[i]
+            else:
+                min_excluded = min(min_excluded, costs[i])
+        yield from search(depth, mask, used, min_excluded, key_score,
+            pair_score, pair_missing)
+    finally:
+        if metrics is not None:
+            metrics.add_counters({'combinations_generated': counts[0],
+                'rejected_by_length': counts[1],
+                'removed_as_subsets': counts[2], 'score_lookups': counts[3]})
+
+def build_mask_tables(values):
+    """Builds lookup tables to sum values over bitmasks.
+
+    Args:
+        values: A list of values, one for each bit.
+
+    Returns:
+        A list of 256 entry arrays, where entry b of table c holds the sum of
+        all values[8*c + i] with bit i of byte b set.
+    """
+    tables = []
+    for c in range(0, len(values), 8):
+        chunk = values[c:c+8]
+        table = array('d', bytes(8 * 256))
+        for b in range(1, 256):
+            high = b.bit_length() - 1
+            table[b] = table[b ^ (1 << high)] + (chunk[high]
+                if high < len(chunk) else 0.0)
+        tables.append(table)
+    return tables
+
+# Worker process state, see init_worker
+_worker_state = None
+
+def init_worker(scorer, max_keylist_len, min_keylist_len, top_k):
+    """Stores score tables and limits once per worker process."""
+    global _worker_state
+    _worker_state = (scorer, max_keylist_len, min_keylist_len, top_k)
+
+def score_shard(prefix):
+    """Returns the top_k (bitmask, score) tuples of a shard in a worker.
+
+    Returns:
+        A tuple of the top_k (bitmask, score) tuples and a dict of counters.
+    """
+    (scorer, max_keylist_len, min_keylist_len, top_k) = _worker_state
+    metrics = Metrics()
+    results = get_top_keylists(metrics.count_iter('keylists_scored',
+        iter_scored_keylist_masks(scorer, max_keylist_len, min_keylist_len,
+        prefix, metrics)), top_k)
+    return (results, metrics.counters)
+
+def get_top_keylist_masks(scorer, max_keylist_len, min_keylist_len, top_k,
+                          workers=1, metrics=None):
+    """Enumerates and scores all candidate keylists, returns the best top_k.
+
+    With more than one worker, the keyword combination space is split into
+    shards (see get_prefix_shards), which are enumerated and scored in a
+    pool of worker processes that receive the score tables once. Shard
+    results are merged in shard order, so scores and ranking (including ties)
+    match the serial path exactly.
+
+    Args:
+        scorer: KeylistScorer of the input keywords.
+        max_keylist_len: Maximum allowed char length of a keyword list.
+        min_keylist_len: Minimum allowed char length of a keyword list.
+        top_k: Number of keylists to keep.
+        workers: Number of worker processes.
+        metrics: Metrics object to count scored keylists, generated
+            combinations, pruned branches and score lookups (optional).
+
+    Returns:
+        A list of (bitmask, score) tuples, highest score first.
+    """
+
+    if metrics is None:
+        metrics = Metrics()
+
+    keys = scorer.keys
+    if len(",".join(keys)) <= max_keylist_len:
+        masks = list(iter_keylist_masks(keys, max_keylist_len,
+            min_keylist_len, metrics))
+        metrics.count('score_lookups', count_mask_lookups(masks,
+            scorer.include_dual_keys))
+        return get_top_keylists(metrics.count_iter('keylists_scored',
+            scorer.iter_scores(masks)), top_k)
+
+    if workers <= 1:
+        return get_top_keylists(metrics.count_iter('keylists_scored',
+            iter_scored_keylist_masks(scorer, max_keylist_len,
+            min_keylist_len, metrics=metrics)), top_k)
+
+    shards = get_prefix_shards(len(keys), 8 * workers)
+    with multiprocessing.Pool(workers, init_worker, (scorer, max_keylist_len,
+            min_keylist_len, top_k)) as pool:
+        shard_results = []
+        for (results, counters) in pool.map(score_shard, shards, chunksize=1):
+            shard_results.append(results)
+            metrics.add_counters(counters)
+
+    # Rank by score, ties in shard order and order within shard
+    merged = [(score, -shard, -pos, mask) for (shard, results) in
+        enumerate(shard_results) for (pos, (mask, score)) in
+        enumerate(results)]
+    merged.sort(reverse=True)
+    return [(mask, score) for (score, shard, pos, mask) in merged[:top_k]]
+
+def anneal_keylist(key_data, keypair_data, include_dual_keys,
+                   max_keylist_len, min_keylist_len, time_budget, seed=None,
+                   progress_interval=1.0):
+    """Search a high scoring keylist within a wall-clock time budget.
+
+    Anytime heuristic for keyword sets too large for an exact search. Starts
+    with a greedy keylist of the keys with the highest score per char (key
+    length plus separating comma) and improves it with simulated annealing.
+    Each move swaps a random key of the keylist for a random unused key (or
+    only inserts one), drops random keys until the keylist fits in
+    max_keylist_len again and fills it up greedily, so every keylist visited
+    is one without sublists. Moves are accepted with the Metropolis
+    criterion, while the temperature cools down over the time budget. The
+    objective equals the cumulative score of process and is updated
+    incrementally with the key and pair values of build_value_tables.
+
+    Keyword scores (and keypair scores if include_dual_keys is set) have to
+    be calculated beforehand with calc_key_scores. The search can be stopped
+    early with Ctrl-C, which returns the best keylist found so far.
+
+    Args:
+        key_data: KeyDataStore object containing all individual keyword scores.
+        keypair_data: KeyDataStore object containing all dual keyword scores.
+        include_dual_keys: Include score of dual key combinations.
+        max_keylist_len: Maximum allowed char length of a keyword list.
+        min_keylist_len: Minimum allowed char length of a keyword list.
+        time_budget: Search time in seconds.
+        seed: Seed of the random number generator (optional).
+        progress_interval: Seconds between progress reports (optional. If 0,
+            no progress reported).
+
+    Returns:
+        A tuple (keylist, score) of the best keylist found, see
+        get_best_keylist, or None if no keylist is within the length limits.
+    """
+
+    keys = key_data.keys
+
+    if len(",".join(keys)) <= max_keylist_len:
+        # Include all input keys, if composite key length below max key length
+        print("Input keys below max char length. Including all keys.")
+        return score_keylist(keys[:], key_data, keypair_data,
+            include_dual_keys, max_keylist_len)
+
+    n = len(keys)
+    (key_values, pair_values, pair_missing, missing_value) = \
+        build_value_tables(key_data, keypair_data, include_dual_keys,
+        max_keylist_len)
+    costs = [len(key) + 1 for key in keys]
+    budget = max_keylist_len + 1
+
+    rng = random.Random(seed)
+    density_order = sorted(range(n), key=lambda i: key_values[i]/costs[i],
+        reverse=True)
+
+    # Current keylist with its used chars, key and pair values and number of
+    # missing key pairs. links[i] and missing_links[i] hold the pair value
+    # and number of missing pairs of key i with all keys of the keylist.
+    chosen = [False] * n
+    state = {'used': 0, 'keys': 0.0, 'pairs': 0.0, 'missing': 0}
+    links = [0.0] * n
+    missing_links = [0] * n
+
+    def add(k):
+        chosen[k] = True
+        state['used'] += costs[k]
+        state['keys'] += key_values[k]
+        state['pairs'] += links[k]
+        state['missing'] += missing_links[k]
+        row = pair_values[k]
+        missing_row = pair_missing[k]
+        for i in range(n):
+            links[i] += row[i]
+            missing_links[i] += missing_row[i]
+
+    def remove(k):
+        chosen[k] = False
+        row = pair_values[k]
+        missing_row = pair_missing[k]
+        for i in range(n):
+            links[i] -= row[i]
+            missing_links[i] -= missing_row[i]
+        state['used'] -= costs[k]
+        state['keys'] -= key_values[k]
+        state['pairs'] -= links[k]
+        state['missing'] -= missing_links[k]
+
+    def fill(moves):
+        # Add keys with the highest score per char, as long as they fit
+        for k in density_order:
+            if not chosen[k] and state['used'] + costs[k] <= budget:
+                add(k)
+                moves.append((remove, k))
+
+    def value():
+        return state['keys'] + (missing_value if state['missing']
+            else state['pairs'])
+
+    def feasible():
+        return max(state['used'] - 1, 0) >= min_keylist_len
+
+    fill([])
+    current = value()
+    best = (current, chosen[:]) if feasible() else (float("-inf"), None)
+
+    # Initial temperature allows to swap keys of average value early on
+    temp_start = max(sum(key_values) / n, 1e-9)
+    temp_end = temp_start * 1e-3
+
+    start_time = time.time()
+    last_report = start_time
+    iterations = 0
+    try:
+        while True:
+            now = time.time()
+            elapsed = now - start_time
+            if elapsed >= time_budget:
+                break
+            if progress_interval and now - last_report >= progress_interval:
+                print("%.1fs: %d iterations, best score %.4f" % (elapsed,
+                    iterations, best[0]))
+                last_report = now
+
+            temp = temp_start * (temp_end/temp_start) ** (elapsed/time_budget)
+            iterations += 1
+
+            # Swap a random key for an unused key, or insert an unused key,
+            # then drop random keys until the keylist fits again
+            # (keys longer than max_keylist_len never fit in)
+            moves = []
+            members = [i for i in range(n) if chosen[i]]
+            unused = [i for i in range(n) if not chosen[i] and
+                costs[i] <= budget]
+            if not unused:
+                break
+            key_in = rng.choice(unused)
+            if members and rng.random() < 0.8:
+                key_out = rng.choice(members)
+                remove(key_out)
+                moves.append((add, key_out))
+                members.remove(key_out)
+            add(key_in)
+            moves.append((remove, key_in))
+            while state['used'] > budget and members:
+                key_out = members.pop(rng.randrange(len(members)))
+                remove(key_out)
+                moves.append((add, key_out))
+            fill(moves)
+
+            candidate = value()
+            delta = candidate - current
+            if delta >= 0 or rng.random() < math.exp(delta/temp):
+                current = candidate
+                if current > best[0] and feasible():
+                    best = (current, chosen[:])
+            else:
+                # Undo moves in reverse order
+                for (move, k) in reversed(moves):
+                    move(k)
+    except KeyboardInterrupt:
+        print("Search interrupted.")
+
+    if best[1] is None:
+        print("%.1fs: %d iterations" % (time.time() - start_time, iterations))
+        print("Error: No keylist within the char length limits.")
+        return None
+    print("%.1fs: %d iterations, best score %.4f" % (time.time() - start_time,
+        iterations, best[0]))
+
+    # Score best keylist the same way as process does
+    best_keylist = [keys[i] for i in range(n) if best[1][i]]
+    return score_keylist(best_keylist, key_data, keypair_data,
+        include_dual_keys, max_keylist_len)
+
+def score_keylist(key_list, key_data, keypair_data, include_dual_keys,
+                  max_keylist_len):
+    """Returns cumulative score of a keylist as calculated by process."""
+    keylist_score = calc_keylist_scores([key_list], key_data,
+        max_keylist_len)[0]
+    if include_dual_keys:
+        keypair_score = calc_keypair_scores([key_list], keypair_data,
+            max_keylist_len)[0]
+        return (key_list, 2/3*keylist_score + 1/3*keypair_score)
+    else:
+        return (key_list, keylist_score)
+
+def get_top_keylists(scored_keylists, top_k):
+    """Returns the top_k highest scoring keylists.
+
+    Consumes (keylist, score) tuples one at a time and only keeps the best
+    top_k of them in a heap, hence memory does not grow with the number of
+    keylists. Keylists with the same score are ranked in the order they were
+    provided, i.e. the first keylist equals the one of get_best_keylist.
+
+    Args:
+        scored_keylists: An iterable of (keylist, score) tuples.
+        top_k: Number of keylists to keep.
+
+    Returns:
+        A list of (keylist, score) tuples, highest score first.
+    """
+    heap = []
+    for i, (keylist, score) in enumerate(scored_keylists):
+        entry = (score, -i, keylist)
+        if len(heap) < top_k:
+            heapq.heappush(heap, entry)
+        elif entry[:2] > heap[0][:2]:
+            heapq.heapreplace(heap, entry)
+
+    return [(keylist, score) for (score, i, keylist) in
+        sorted(heap, key=lambda entry: entry[:2], reverse=True)]
+
+def process(key_data, keypair_data, include_dual_keys, max_keylist_len,
+            min_keylist_len, w_factors, apps_base, keylen_base,
+            method="exhaustive", top_k=1, dump_files=False, workers=1,
+            time_budget=10, seed=None, cache=None, metrics=None,
+            outputs=None, output_format="csv"):
+    """Select the highest scoring keylists.
+
+    By default candidate keylists are streamed as bitmasks and scored while
+    they are built (see iter_scored_keylist_masks), keeping only the best
+    top_k of them (in parallel with more than one worker process). With dump_files set,
+    all keylists and scores are materialized and exported to out_*.csv files
+    (only outputs, if given, in output_format, see process_all).
+    Given a KeylistCache, candidate keylists are read from cache instead
+    of enumerated if possible. Given a Metrics object, run time and memory
+    of all stages are recorded in it, as well as counters of generated
+    combinations, score lookups, missing scores and rows written.
+
+    Returns:
+        A list of the top_k (keylist, score) tuples, highest score first.
+    """
+
+    if method == "branch_bound":
+        # Calculate keyword scores and search best keylist without
+        # enumerating all keyword combinations
+        with measure_stage(metrics, 'calc_key_scores'):
+            calc_key_scores(key_data, w_factors, apps_base, keylen_base)
+            if include_dual_keys:
+                calc_key_scores(keypair_data, w_factors, apps_base,
+                    keylen_base)
+        with measure_stage(metrics, 'search'):
+            best_keylist = find_best_keylist(key_data, keypair_data,
+                include_dual_keys, max_keylist_len, min_keylist_len)
+        best_keylists = [best_keylist] if best_keylist else []
+
+    elif method == "anneal":
+        # Calculate keyword scores and search a high scoring keylist within
+        # the time budget
+        with measure_stage(metrics, 'calc_key_scores'):
+            calc_key_scores(key_data, w_factors, apps_base, keylen_base)
+            if include_dual_keys:
+                calc_key_scores(keypair_data, w_factors, apps_base,
+                    keylen_base)
+        with measure_stage(metrics, 'search'):
+            best_keylist = anneal_keylist(key_data, keypair_data,
+                include_dual_keys, max_keylist_len, min_keylist_len,
+                time_budget, seed)
+        best_keylists = [best_keylist] if best_keylist else []
+
+    elif not dump_files:
+        # Calculate individual keyword scores
+        with measure_stage(metrics, 'calc_key_scores'):
+            calc_key_scores(key_data, w_factors, apps_base, keylen_base)
+            if include_dual_keys:
+                calc_key_scores(keypair_data, w_factors, apps_base,
+                    keylen_base)
+
+        # Score keylists as bitmasks in batches as they are generated, decode
+        # best keylists only
+        print("input keys: ", key_data.keys, "\n")
+        with measure_stage(metrics, 'build_score_tables'):
+            scorer = KeylistScorer(key_data, keypair_data, include_dual_keys,
+                max_keylist_len)
+        if metrics is not None:
+            # Keys and key pairs without score, scored as errors
+            metrics.count('missing_key_errors', bin(scorer.missing_keys
+                ).count("1") + sum(bin(missing).count("1") for missing in
+                scorer.missing_pairs))
+        with measure_stage(metrics, 'enumerate_and_score'):
+            if cache is None:
+                top_masks = get_top_keylist_masks(scorer, max_keylist_len,
+                    min_keylist_len, top_k, workers, metrics)
+            else:
+                masks = cache.get_masks(key_data.keys, max_keylist_len,
+                    min_keylist_len)
+                if metrics is not None:
+                    metrics.count('keylists_scored', len(masks))
+                    metrics.count('score_lookups', count_mask_lookups(masks,
+                        include_dual_keys))
+                top_masks = get_top_keylists(scorer.iter_scores(masks), top_k)
+        best_keylists = [(decode_keylist(mask, key_data.keys), score) for
+            (mask, score) in top_masks]
+
+    else:
+        best_keylists = process_all(key_data, keypair_data, include_dual_keys,
+            max_keylist_len, min_keylist_len, w_factors, apps_base,
+            keylen_base, top_k, cache, metrics, outputs, output_format)
+
+    if not best_keylists:
+        print("Error: Provided empty keylist.")
+        return []
+
+    (best_keylist, best_score) = best_keylists[0]
+    print("Woohoo, the keylist (%s) has the highest score with %.2f points!\n"
         % (','.join(best_keylist), best_score))
+    for rank, (keylist, score) in enumerate(best_keylists[1:], 2):
+        print("%d. (%s) with %.2f points" % (rank, ','.join(keylist), score))
+
+    return best_keylists
+
+def count_mask_lookups(masks, include_dual_keys):
+    """Counts score lookups of keylists given as bitmasks.
+
+    Scoring a keylist of k keys looks up k keyword scores and, including
+    dual keys, k*(k-1) key pair scores, see count_score_lookups.
+    """
+    lookups = 0
+    for mask in masks:
+        k = bin(mask).count("1")
+        lookups += k + k*(k-1) if include_dual_keys else k
+    return lookups
+
+def count_score_lookups(key_lists, key_data, keypair_data, include_dual_keys):
+    """Counts keyword and key pair score lookups of keylist scores.
+
+    Returns:
+        A tuple (lookups, errors), where errors is the number of lookups of
+        keys or key pairs without score, see get_key_score.
+    """
+    keys = key_data.keys
+    n = len(keys)
+    masks = encode_keylists(key_lists, keys)
+    lookups = sum(len(key_list) for key_list in key_lists)
+    errors = sum(len(key_list) for key_list in key_lists) - sum(1 for
+        key_list in key_lists for key in key_list if key in key_data.index)
+
+    if include_dual_keys:
+        lookups += sum(len(key_list) * (len(key_list)-1) for key_list in
+            key_lists)
+        missing = build_keypair_table(keys, keypair_data)[1]
+        missing_rows = [sum(1 << j for j in range(n) if missing[i][j]) for i
+            in range(n)]
+        for mask in masks:
+            m = mask
+            while m:
+                low = m & -m
+                errors += bin(mask & missing_rows[low.bit_length() - 1]
+                    ).count("1")
+                m ^= low
+
+    return (lookups, errors)
+
+# Output files of process_all
+OUTPUT_FILES = {'keylists': 'out_keylists.csv',
+    'key_scores': 'out_key_scores.csv',
+    'keylist_scores': 'out_keylist_scores.csv',
+    'keypair_scores': 'out_keypair_scores.csv',
+    'keylist_keypair_scores': 'out_keylist_keypair_scores.csv',
+    'keylist_scores_cum': 'out_keylist_scores_cum.csv'}
+
+OUTPUT_FORMATS = ('csv', 'gz', 'bin')
+
+WRITE_BUFFER_SIZE = 1 << 20
+
+# Binary output table header: magic, number of rows, number of columns
+TABLE_MAGIC = b'KLT1' + sys.byteorder[0].encode() + b'   '
+TABLE_HEADER = struct.Struct('8sQQ')
+
+class OutputWriter(object):
+    """Object to export output files in a background thread.
+
+    Output files are queued with submit and written one after another by a
+    writer thread, with rows generated in that thread as well, so the
+    calling thread never waits for disk. Rows must not change after they
+    were submitted.
+
+    Attributes:
+        format: Output format, one of OUTPUT_FORMATS. csv writes csv files,
+            gz gzip compressed csv files (.csv.gz) and bin binary columnar
+            tables (.bin, see write_output_table).
+        files: List of names of all written files.
+    """
+
+    def __init__(self, format="csv"):
+        if format not in OUTPUT_FORMATS:
+            raise ValueError("Unknown output format '%s'" % format)
+        self.format = format
+        self.files = []
+        self.error = None
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_file(self, file):
+        """Returns the name of file in the output format."""
+        if self.format == 'gz':
+            return file + '.gz'
+        elif self.format == 'bin':
+            return os.path.splitext(file)[0] + '.bin'
+        return file
+
+    def submit(self, file, header, rows, message="", **fmtparams):
+        """Queues an output file, see write_output."""
+        self.jobs.put((self.get_file(file), header, rows, message, fmtparams))
+
+    def run(self):
+        """Writes queued output files until closed."""
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            (file, header, rows, message, fmtparams) = job
+            if self.error is not None:
+                continue
+            try:
+                if self.format == 'bin':
+                    write_output_table(file, header, rows)
+                else:
+                    write_csv(file, header, rows, self.format == 'gz',
+                        **fmtparams)
+            except Exception as e:
+                # Keep consuming jobs, report error on close
+                self.error = e
+                continue
+            self.files.append(file)
+            if message:
+                print(message % file)
+
+    def close(self):
+        """Waits for all queued files to be written.
+
+        Raises:
+            IOError: If an output file could not be written.
+        """
+        if self.thread.is_alive():
+            self.jobs.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise IOError("Could not write output files. %s" % self.error)
+
+def write_output(file, header, rows, message="", writer=None, **fmtparams):
+    """Exports rows to output file.
+
+    Args:
+        file: Name of output csv file.
+        header: List of column names or None for a file without header.
+        rows: An iterable of rows.
+        message: Message to print when done, with placeholder for file name.
+        writer: OutputWriter object to export the file in the background in
+            its output format (optional. If None, csv file is written now).
+        fmtparams: Formatting parameters of the csv writer.
+    """
+    if writer is not None:
+        writer.submit(file, header, rows, message, **fmtparams)
+    else:
+        write_csv(file, header, rows, **fmtparams)
+        if message:
+            print(message % file)
+
+def write_csv(file, header, rows, compress=False, **fmtparams):
+    """Writes rows to csv (or gzip compressed csv) file."""
+    if compress:
+        csvfile = io.TextIOWrapper(io.BufferedWriter(gzip.open(file, 'wb',
+            compresslevel=6), WRITE_BUFFER_SIZE), newline='', encoding='utf8')
+    else:
+        csvfile = open(file, 'w', WRITE_BUFFER_SIZE, newline='',
+            encoding='utf8')
+    with csvfile:
+        csvwriter = csv.writer(csvfile, **fmtparams)
+        if header is not None:
+            csvwriter.writerow(header)
+        csvwriter.writerows(rows)
+
+def write_output_table(file, header, rows):
+    """Writes rows to binary columnar table file.
+
+    The file holds a header and all columns one after another, each as
+    utf-8 encoded name, type code ('q' int64, 'd' float64 or 's' utf-8
+    encoded strings separated by newlines), byte length and data. List
+    cells are stored as comma separated strings. Rows of a file without
+    header are stored as a single column 'keylist'.
+    """
+    if header is None:
+        header = ['keylist']
+        rows = ([",".join(row)] for row in rows)
+    columns = [list(column) for column in zip(*rows)] or [[] for name in
+        header]
+
+    with open(file, 'wb', WRITE_BUFFER_SIZE) as table:
+        table.write(TABLE_HEADER.pack(TABLE_MAGIC, len(columns[0]),
+            len(header)))
+        for (name, column) in zip(header, columns):
+            if all(type(cell) is int for cell in column):
+                (code, data) = ('q', array('q', column).tobytes())
+            elif all(type(cell) in (int, float) for cell in column):
+                (code, data) = ('d', array('d', column).tobytes())
+            else:
+                code = 's'
+                data = "\n".join(",".join(cell) if isinstance(cell, list)
+                    else str(cell) for cell in column).encode('utf-8')
+            name = name.encode('utf-8')
+            table.write(struct.pack('Q', len(name)) + name + code.encode() +
+                struct.pack('Q', len(data)))
+            table.write(data)
+
+def read_output_table(file):
+    """Reads binary columnar table file, see write_output_table.
+
+    Returns:
+        A tuple of the list of column names and the list of columns (arrays
+        of numbers or lists of strings).
+
+    Raises:
+        ValueError: If file is no binary table file.
+    """
+    with open(file, 'rb') as table:
+        data = table.read()
+
+    (magic, n_rows, n_columns) = TABLE_HEADER.unpack_from(data)
+    if magic != TABLE_MAGIC:
+        raise ValueError("No binary table file: %s" % file)
+    offset = TABLE_HEADER.size
+
+    header = []
+    columns = []
+    for c in range(n_columns):
+        (name_len,) = struct.unpack_from('Q', data, offset)
+        offset += 8
+        header.append(data[offset:offset + name_len].decode('utf-8'))
+        offset += name_len
+        code = chr(data[offset])
+        (data_len,) = struct.unpack_from('Q', data, offset + 1)
+        offset += 9
+        if code == 's':
+            column = data[offset:offset + data_len].decode('utf-8').split(
+                "\n") if n_rows else []
+        else:
+            column = array(code)
+            column.frombytes(data[offset:offset + data_len])
+        columns.append(column)
+        offset += data_len
+
+    return (header, columns)
+
+def process_all(key_data, keypair_data, include_dual_keys, max_keylist_len, 
+                min_keylist_len, w_factors, apps_base, keylen_base, top_k=1,
+                cache=None, metrics=None, outputs=None, output_format="csv"):
+    """Scores all keylists at once and exports all scores to out_*.csv.
+
+    Output files are written by an OutputWriter in the background, only the
+    files named in outputs (keys of OUTPUT_FILES, all if None) are written.
+    Stages recorded in metrics don't include the time to write files.
+    """
+
+    if outputs is None:
+        outputs = OUTPUT_FILES
+    files = {name: (file if name in outputs else "") for (name, file) in
+        OUTPUT_FILES.items()}
+
+    with OutputWriter(output_format) as writer:
+        # Determine keylist permutations
+        key_lists = calc_keylist_permutations(key_data.keys,
+            max_keylist_len, min_keylist_len, files['keylists'], cache,
+            metrics, writer)
+
+        # Calculate individual keyword scores
+        with measure_stage(metrics, 'calc_key_scores'):
+            key_scores = calc_key_scores(key_data, w_factors, apps_base, 
+                keylen_base, files['key_scores'], writer)
+
+        # Calculate keylist scores
+        with measure_stage(metrics, 'calc_keylist_scores'):
+            keylist_scores = calc_keylist_scores(key_lists, key_data,
+                max_keylist_len, files['keylist_scores'], writer)
+
+        cumulative_scores = []
+        if include_dual_keys:
+            # Calculate additional score of dual key combinations of keylist
+            with measure_stage(metrics, 'calc_key_scores'):
+                keypair_scores = calc_key_scores(keypair_data, w_factors,
+                    apps_base, keylen_base, files['keypair_scores'], writer)
+            with measure_stage(metrics, 'calc_keypair_scores'):
+                keylist_keypair_scores = calc_keypair_scores(key_lists,
+                    keypair_data, max_keylist_len,
+                    files['keylist_keypair_scores'], writer)
+                
+            # Calculate cumulative keylist scores, which equals the sum of the 
+            # individual keyword scores (twice as important) and the dual key 
+            # combination score
+            cumulative_scores = [score for score in map(
+                lambda x,y:2/3*x + 1/3*y, keylist_scores,
+                keylist_keypair_scores)]
+        else:
+            keylist_keypair_scores = [0 for score in keylist_scores]
+            cumulative_scores = keylist_scores[:]
+
+        if files['keylist_scores_cum']:
+            def get_rows():
+                for i in range(len(key_lists)):
+                    keylist = ",".join(key_lists[i])
+                    yield [keylist, keylist_scores[i],
+                        keylist_keypair_scores[i], cumulative_scores[i],
+                        len(keylist), len(key_lists[i])]
+
+            write_output(files['keylist_scores_cum'], ['keylist', 'key_score',
+                'keypair_score', 'cumulative_score', 'length', 'words'],
+                get_rows(), "Cumulative keylist scores exported to file: %s",
+                writer, delimiter=';', quoting=csv.QUOTE_NONE)
+
+    if metrics is not None:
+        (lookups, errors) = count_score_lookups(key_lists, key_data,
+            keypair_data, include_dual_keys)
+        metrics.count('score_lookups', lookups)
+        metrics.count('missing_key_errors', errors)
+        # Rows of all score files, keylists are counted by 
+        # calc_keylist_permutations
+        rows = {'key_scores': len(key_data.keys),
+            'keypair_scores': len(keypair_data.keys) if include_dual_keys
+            else 0,
+            'keylist_scores': len(key_lists),
+            'keylist_keypair_scores': len(key_lists) if include_dual_keys
+            else 0,
+            'keylist_scores_cum': len(key_lists)}
+        metrics.count('rows_written', sum(count for (name, count) in
+            rows.items() if files[name]))
+
+    # Get keylists with highest score
+    return get_top_keylists(zip(key_lists, cumulative_scores), top_k)
+
+def calc_score_components(key_data, apps_base, keylen_base):
+    """Calculates the weight independent components of keyword scores.
+
+    The score of calc_key_scores equals the dot product of the factor
+    weights (w_diff, w_traffic, 1, w_apps, w_keylen) and the score
+    components (norm_diff, 1, norm_traffic, norm_apps, norm_keylen).
+
+    Returns:
+        A list of the five component columns.
+    """
+    n = len(key_data.keys)
+    return [reverse_column(key_data.avg_diff), array('d', [1.0]) * n, key_data.traffic,
+        normalize_column(key_data.avg_apps, apps_base),
+        normalize_column(key_data.key_len, keylen_base)]
+
+def sweep_weights(key_data, keypair_data, include_dual_keys, max_keylist_len,
+                  min_keylist_len, settings, file="", cache=None):
+    """Determine the best keylist for each of a grid of weight settings.
+
+    Candidate keylists are enumerated once. Keyword scores are linear in the
+    factor weights (see calc_score_components), so for each keylist the sums
+    of all score components over its keys and key pairs are calculated once
+    per distinct pair of apps_base and keylen_base, and the cumulative score
+    of every weight setting follows as a dot product with the weights. Best
+    keylists are rescored the same way as process does.
+
+    Args:
+        key_data: KeyDataStore object containing all keyword metrics.
+        keypair_data: KeyDataStore object containing all dual keyword metrics.
+        include_dual_keys: Include score of dual key combinations.
+        max_keylist_len: Maximum allowed char length of a keyword list.
+        min_keylist_len: Minimum allowed char length of a keyword list.
+        settings: A list of dicts with keys w_diff, w_traffic, w_apps,
+            w_keylen, apps_base and keylen_base.
+        file: Name of output file (optional. If left empty, no file stored).
+        cache: KeylistCache object to read candidate keylists from or store
+            them to (optional).
+
+    Returns:
+        A list of (setting, keylist, score, changed) tuples in the order of
+        settings, where changed is True if the best keylist differs from the
+        one of the previous setting. Settings with weights that don't add up
+        to 1 get an empty keylist and are marked as errors in file.
+    """
+
+    keys = key_data.keys
+    n = len(keys)
+    masks = get_keylist_masks(keys, max_keylist_len, min_keylist_len, cache)
+    if not masks:
+        print("Error: Provided empty keylist.")
+        return []
+
+    max_keys = max_keylist_len/2
+    key_max_score = max_keylist_len/2 * 10
+    pair_max_score = max_keys * (max_keys-1) * 10
+
+    best_masks = [None] * len(settings)
+    errors = {}
+
+    # Group settings by normalization bases, only weights are linear
+    groups = {}
+    for i, setting in enumerate(settings):
+        w_sum = (setting['w_diff'] + setting['w_traffic'] +
+            setting['w_apps'] + setting['w_keylen'])
+        if not math.isclose(w_sum, 1):
+            errors[i] = "Factor weights don't add up to 100%."
+            print("Error: %s" % errors[i], setting)
+            continue
+        groups.setdefault((setting['apps_base'], setting['keylen_base']),
+            []).append(i)
+
+    for ((apps_base, keylen_base), group) in groups.items():
+        # Lookup tables of score components over keys and key pairs
+        components = calc_score_components(key_data, apps_base, keylen_base)
+        key_tables = [build_mask_tables([column[key_data.index[key]]
+            for key in keys]) for column in components]
+
+        pair_tables = [[] for i in range(n)]
+        missing_pairs = [0] * n
+        if include_dual_keys:
+            for column in calc_score_components(keypair_data, apps_base,
+                    keylen_base):
+                (table, missing) = build_keypair_table(keys, keypair_data,
+                    column)
+                for i in range(n):
+                    pair_tables[i].append(build_mask_tables(table[i]))
+            for i in range(n):
+                missing_pairs[i] = sum(1 << j for j in range(n)
+                    if missing[i][j])
+
+        # Weight vectors of the settings, scaled by the keylist
+        # normalization and the importance of key and keypair scores
+        if include_dual_keys:
+            (key_factor, pair_factor) = (2/3 / key_max_score,
+                1/3 / pair_max_score)
+        else:
+            (key_factor, pair_factor) = (1 / key_max_score, 0)
+        weights = [(i, [settings[i]['w_diff'], settings[i]['w_traffic'], 1,
+            settings[i]['w_apps'], settings[i]['w_keylen']]) for i in group]
+        best = [float("-inf")] * len(weights)
+
+        for mask in masks:
+            key_sums = [0.0] * 5
+            for (c, tables) in enumerate(key_tables):
+                cols = mask
+                for table in tables:
+                    if not cols:
+                        break
+                    key_sums[c] += table[cols & 255]
+                    cols >>= 8
+
+            pair_sums = [0.0] * 5
+            pair_missing = False
+            if include_dual_keys:
+                rows = mask
+                while rows:
+                    low = rows & -rows
+                    i = low.bit_length() - 1
+                    rows ^= low
+                    if mask & missing_pairs[i]:
+                        pair_missing = True
+                        break
+                    for (c, tables) in enumerate(pair_tables[i]):
+                        cols = mask
+                        for table in tables:
+                            if not cols:
+                                break
+                            pair_sums[c] += table[cols & 255]
+                            cols >>= 8
+
+            for (g, (i, w)) in enumerate(weights):
+                score = key_factor * (w[0]*key_sums[0] + w[1]*key_sums[1] +
+                    key_sums[2] + w[3]*key_sums[3] + w[4]*key_sums[4])
+                if pair_missing:
+                    score += pair_factor * -99
+                else:
+                    score += pair_factor * (w[0]*pair_sums[0] +
+                        w[1]*pair_sums[1] + pair_sums[2] + w[3]*pair_sums[3] +
+                        w[4]*pair_sums[4])
+                if score > best[g]:
+                    best[g] = score
+                    best_masks[i] = mask
+
+    # Rescore best keylists the same way as process does
+    results = []
+    previous = None
+    for (setting, mask) in zip(settings, best_masks):
+        if mask is None:
+            results.append((setting, [], 0, False))
+            continue
+        w_factors = dict((w, setting[w]) for w in ('w_diff', 'w_traffic',
+            'w_apps', 'w_keylen'))
+        calc_key_scores(key_data, w_factors, setting['apps_base'],
+            setting['keylen_base'])
+        if include_dual_keys:
+            calc_key_scores(keypair_data, w_factors, setting['apps_base'],
+                setting['keylen_base'])
+        (keylist, score) = score_keylist(decode_keylist(mask, keys), key_data,
+            keypair_data, include_dual_keys, max_keylist_len)
+        results.append((setting, keylist, score, previous is not None and
+            mask != previous))
+        previous = mask
+
+    if file != "":
+        with open(file, 'w', newline='', encoding='utf8') as csvfile:
+            csvwriter = csv.writer(csvfile, delimiter=';',
+                quoting=csv.QUOTE_NONE)
+            csvwriter.writerow(['w_diff', 'w_traffic', 'w_apps', 'w_keylen',
+                'apps_base', 'keylen_base', 'keylist', 'score', 'changed',
+                'error'])
+            for (i, (setting, keylist, score, changed)) in enumerate(results):
+                csvwriter.writerow([setting['w_diff'], setting['w_traffic'],
+                    setting['w_apps'], setting['w_keylen'],
+                    setting['apps_base'], setting['keylen_base'],
+                    ",".join(keylist), score, int(changed),
+                    errors.get(i, "")])
+        print("Weight sweep exported to file: %s" % file)
+
+    return results
+
+def read_in_sweep_settings(file, defaults):
+    """Read in grid of weight settings.
+
+    Args:
+        file: Name of csv file with any of the columns w_diff, w_traffic,
+            w_apps, w_keylen, apps_base and keylen_base.
+        defaults: Dict of values of missing columns.
+
+    Returns:
+        A list of setting dicts, see sweep_weights.
+    """
+    settings = []
+    try:
+        with open(file, 'r', newline='', encoding='utf-8-sig') as csvfile:
+            for row in csv.DictReader(csvfile):
+                setting = dict(defaults)
+                for name in defaults:
+                    if row.get(name):
+                        setting[name] = float(row[name])
+                settings.append(setting)
+    except (IOError, ValueError) as e:
+        print('Exception: %s' % e)
+    return settings
+
+def calc_marginal_gains(key_list, key_data, keypair_data, candidates,
+                        include_dual_keys, max_keylist_len,
+                        candidate_pairs=None, file=""):
+    """Calculates the effect of adding each candidate keyword to a keylist.
+
+    Key and key pair scores of the keylist are looked up once (see
+    KeylistScorer), each candidate only adds its own key score and the scores
+    of its key pairs with the keylist keys, hence all candidates are
+    evaluated in one pass without enumerating keylists. If a candidate
+    doesn't fit into max_keylist_len, keylist keys are dropped one at a time,
+    each time the key whose removal keeps the highest score (among removals
+    that make the candidate fit, if any). Scores are the cumulative scores of
+    process, keyword scores have to be calculated first (see calc_key_scores).
+
+    Args:
+        key_list: A keyword list, e.g. the best keylist of process.
+        key_data: KeyDataStore object containing all keyword metrics.
+        keypair_data: KeyDataStore object containing all dual keyword metrics.
+        candidates: KeyDataStore object containing the candidate keywords.
+        include_dual_keys: Include score of dual key combinations.
+        max_keylist_len: Maximum allowed char length of a keyword list.
+        candidate_pairs: KeyDataStore object containing dual keyword metrics
+            of the candidates (optional, looked up in keypair_data first).
+        file: Name of output file (optional. If left empty, no file stored).
+
+    Returns:
+        A list of (key, key_score, keypair_score, dropped, keylist, score,
+        gain) tuples, highest gain first, where key_score and keypair_score
+        are the scores the candidate adds (keypair_score with the remaining
+        keys, -99 if any key pair is missing), dropped the list of removed
+        keys, keylist and score the resulting keylist and its cumulative
+        score and gain the difference to the score of key_list.
+    """
+
+    n = len(key_list)
+    scorer = KeylistScorer(key_data, keypair_data, include_dual_keys,
+        max_keylist_len, key_list)
+    base_mask = (1 << n) - 1
+    base_score = scorer.score([base_mask])[2][0]
+    key_cost = [len(key) + 1 for key in key_list]
+    key_scores = scorer.key_scores
+    pair_rows = scorer.pair_rows if include_dual_keys else [[0.0] * n] * n
+    missing_pairs = scorer.missing_pairs if include_dual_keys else [0] * n
+
+    def get_pair_score(pair):
+        for store in (candidate_pairs, keypair_data):
+            row = None if store is None else store.index.get(pair)
+            if row is not None:
+                return store.scores[row]
+        return None
+
+    results = []
+    seen = set(key_list)
+    for (c, key) in enumerate(candidates.keys):
+        if key in seen:
+            continue
+        seen.add(key)
+
+        # Scores of both orderings of the key pairs with each keylist key
+        cand_row = [0.0] * n
+        cand_missing = 0
+        if include_dual_keys:
+            for (i, other) in enumerate(key_list):
+                pair_scores = (get_pair_score(key + " " + other),
+                    get_pair_score(other + " " + key))
+                if None in pair_scores:
+                    cand_missing |= 1 << i
+                else:
+                    cand_row[i] = pair_scores[0] + pair_scores[1]
+
+        def get_score(mask, key_score, pair_score, cand_score):
+            pair_missing = bool(mask & cand_missing) or any(mask &
+                missing_pairs[i] for i in range(n) if mask >> i & 1)
+            return scorer.cumulative_score(key_score +
+                candidates.scores[c], pair_score + cand_score,
+                mask & scorer.missing_keys, pair_missing)
+
+        # Raw score sums of the kept keylist keys
+        mask = base_mask
+        key_score = sum(key_scores)
+        pair_score = sum(map(sum, pair_rows)) / 2
+        cand_score = sum(cand_row)
+        cost = sum(key_cost) + len(key) + 1
+        score = get_score(mask, key_score, pair_score, cand_score)
+
+        while cost - 1 > max_keylist_len and mask:
+            options = []
+            for i in range(n):
+                if mask >> i & 1:
+                    drop_pair = sum(pair_rows[i][j] for j in range(n) if
+                        mask >> j & 1)
+                    option = (mask ^ (1 << i), key_score - key_scores[i],
+                        pair_score - drop_pair, cand_score - cand_row[i])
+                    options.append((cost - key_cost[i] - 1 <=
+                        max_keylist_len, get_score(*option), -i, option,
+                        key_cost[i]))
+            (fits, score, i, (mask, key_score, pair_score, cand_score),
+                drop_cost) = max(options, key=operator.itemgetter(0, 1, 2))
+            cost -= drop_cost
+
+        if cost - 1 > max_keylist_len:
+            # Candidate alone exceeds max_keylist_len
+            continue
+
+        new_keylist = [k for (i, k) in enumerate(key_list) if mask >> i & 1]
+        dropped = [k for (i, k) in enumerate(key_list) if not mask >> i & 1]
+        results.append((key, candidates.scores[c], -99 if mask & cand_missing
+            else cand_score, dropped, new_keylist + [key], score,
+            score - base_score))
+
+    results.sort(key=operator.itemgetter(6), reverse=True)
+
+    if file != "":
+        with open(file, 'w', newline='', encoding='utf8') as csvfile:
+            csvwriter = csv.writer(csvfile, delimiter=';',
+                quoting=csv.QUOTE_NONE)
+            csvwriter.writerow(['key', 'key_score', 'keypair_score',
+                'dropped', 'keylist', 'score', 'gain'])
+            for (key, key_score, pair_score, dropped, keylist, score,
+                    gain) in results:
+                csvwriter.writerow([key, key_score, pair_score,
+                    ",".join(dropped), ",".join(keylist), score, gain])
+        print("Marginal gains exported to file: %s" % file)
+
+    return results
+
+class SelectionState(object):
+    """Object to keep a keyword selection up to date with changing metrics.
+
+    Holds keyword data, all candidate keylists (as bitmasks) and their
+    cumulative scores. Metric updates of a few keys or key pairs only
+    rescore those keys and the candidates including them, and the top_k
+    keylists are then selected from the stored scores without enumerating
+    candidates again. Candidates are only enumerated again if the key set,
+    the length limits or the score settings change. States can be saved to
+    and loaded from file.
+
+    Attributes:
+        key_data: KeyDataStore object containing all keyword metrics.
+        keypair_data: KeyDataStore object containing all dual keyword metrics.
+        include_dual_keys: Include score of dual key combinations.
+        max_keylist_len: Maximum allowed char length of a keyword list.
+        min_keylist_len: Minimum allowed char length of a keyword list.
+        w_factors: Factor weights.
+        apps_base: Integer value used to normalize key metric number of apps.
+        keylen_base: Integer value used to normalize keyword length metric.
+        top_k: Number of keylists to keep.
+        cache: KeylistCache object to read candidate keylists from (optional,
+            not saved).
+        masks: Candidate keylists as bitmasks over key_data.keys.
+        scores: Cumulative score of each candidate keylist.
+        best_keylists: The top_k (keylist, score) tuples.
+    """
+
+    def __init__(self, key_data, keypair_data, include_dual_keys,
+                 max_keylist_len, min_keylist_len, w_factors, apps_base,
+                 keylen_base, top_k=1, cache=None):
+        self.key_data = key_data
+        self.keypair_data = keypair_data
+        self.include_dual_keys = include_dual_keys
+        self.max_keylist_len = max_keylist_len
+        self.min_keylist_len = min_keylist_len
+        self.w_factors = w_factors
+        self.apps_base = apps_base
+        self.keylen_base = keylen_base
+        self.top_k = top_k
+        self.cache = cache
+        self.rebuild()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['cache'] = None
+        return state
+
+    def rebuild(self):
+        """Enumerates and scores all candidate keylists."""
+        calc_key_scores(self.key_data, self.w_factors, self.apps_base,
+            self.keylen_base)
+        if self.include_dual_keys:
+            calc_key_scores(self.keypair_data, self.w_factors, self.apps_base,
+                self.keylen_base)
+
+        self.masks = get_keylist_masks(self.key_data.keys,
+            self.max_keylist_len, self.min_keylist_len, self.cache)
+        self.scores = self.get_scorer().score(self.masks)[2]
+        self.select()
+
+    def get_scorer(self):
+        """Returns a KeylistScorer of the current scores."""
+        return KeylistScorer(self.key_data, self.keypair_data,
+            self.include_dual_keys, self.max_keylist_len)
+
+    def select(self):
+        """Selects the top_k keylists from the stored scores."""
+        keys = self.key_data.keys
+        self.best_keylists = [(decode_keylist(mask, keys), score) for
+            (mask, score) in get_top_keylists(zip(self.masks, self.scores),
+            self.top_k)]
+        return self.best_keylists
+
+    def set_limits(self, max_keylist_len, min_keylist_len):
+        """Changes length limits, enumerates candidates again if required."""
+        return self.set_settings(max_keylist_len, min_keylist_len,
+            self.include_dual_keys, self.w_factors, self.apps_base,
+            self.keylen_base, self.top_k)
+
+    def set_settings(self, max_keylist_len, min_keylist_len,
+                     include_dual_keys, w_factors, apps_base, keylen_base,
+                     top_k):
+        """Changes length limits, score settings and top_k.
+
+        Candidates are enumerated and scored again if any limit or score
+        setting changed, the top_k keylists are selected again if only top_k
+        changed.
+
+        Returns:
+            The top_k (keylist, score) tuples.
+        """
+        settings = (max_keylist_len, min_keylist_len, include_dual_keys,
+            w_factors, apps_base, keylen_base)
+        if settings != (self.max_keylist_len, self.min_keylist_len,
+                self.include_dual_keys, self.w_factors, self.apps_base,
+                self.keylen_base):
+            (self.max_keylist_len, self.min_keylist_len,
+                self.include_dual_keys, self.w_factors, self.apps_base,
+                self.keylen_base) = settings
+            self.top_k = top_k
+            self.rebuild()
+        elif top_k != self.top_k:
+            self.top_k = top_k
+            self.select()
+        return self.best_keylists
+
+    def apply_delta(self, key_delta, keypair_delta):
+        """Applies metric updates of keys and key pairs.
+
+        Rows of key_delta with keys not yet part of the key set add new keys
+        and trigger a full rebuild, new rows of keypair_delta are added to
+        the key pair data.
+
+        Args:
+            key_delta: KeyDataStore object with changed keyword metrics.
+            keypair_delta: KeyDataStore object with changed dual keyword
+                metrics.
+
+        Returns:
+            The top_k (keylist, score) tuples.
+        """
+
+        key_data = self.key_data
+        keypair_data = self.keypair_data
+        n = len(key_data.keys)
+
+        changed_keys = update_keydata(key_data, key_delta)
+        changed_pairs = update_keydata(keypair_data, keypair_delta)
+
+        if len(key_data.keys) != n:
+            # Key set changed
+            self.rebuild()
+            return self.best_keylists
+
+        # Rescore changed rows only
+        rescore_keydata(key_data, changed_keys, self.w_factors,
+            self.apps_base, self.keylen_base)
+        if self.include_dual_keys:
+            rescore_keydata(keypair_data, changed_pairs, self.w_factors,
+                self.apps_base, self.keylen_base)
+
+        # Bitmasks of changed keys and of both keys of changed key pairs
+        key_bits = {}
+        for i, key in enumerate(key_data.keys):
+            key_bits.setdefault(key, 1 << i)
+        changed_mask = 0
+        for i in changed_keys:
+            changed_mask |= key_bits[key_data.keys[i]]
+        pair_masks = set()
+        if self.include_dual_keys:
+            for i in changed_pairs:
+                pair = keypair_data.keys[i].split(" ")
+                if (len(pair) == 2 and pair[0] in key_bits and
+                        pair[1] in key_bits):
+                    pair_masks.add(key_bits[pair[0]] | key_bits[pair[1]])
+
+        # Rescore candidates including a changed key or key pair
+        affected = [c for (c, mask) in enumerate(self.masks) if
+            mask & changed_mask or any(mask & pair_mask == pair_mask
+            for pair_mask in pair_masks)]
+        if affected:
+            scores = self.get_scorer().score(new_mask_array(key_data.keys,
+                [self.masks[c] for c in affected]))[2]
+            for (c, score) in zip(affected, scores):
+                self.scores[c] = score
+
+        return self.select()
+
+    def save(self, file):
+        """Saves state to file."""
+        with open(file, 'wb') as state_file:
+            pickle.dump(self, state_file, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(file):
+        """Loads state from file, returns None if there is no state file."""
+        try:
+            with open(file, 'rb') as state_file:
+                return pickle.load(state_file)
+        except IOError:
+            return None
+
+def update_keydata(key_data, delta):
+    """Updates metrics of key_data with rows of delta, adds new keys.
+
+    Returns:
+        A set of positions of all updated or added keys of key_data.
+    """
+    changed = set()
+    for i, key in enumerate(delta.keys):
+        metrics = (delta.traffic[i], delta.iphone_diff[i],
+            delta.iphone_apps[i], delta.ipad_diff[i], delta.ipad_apps[i])
+        row = key_data.index.get(key)
+        if row is None:
+            row = len(key_data.keys)
+            key_data.add_key(key, *metrics)
+        else:
+            key_data.update_key(row, *metrics)
+        changed.add(row)
+    return changed
+
+def rescore_keydata(key_data, rows, w_factors, apps_base, keylen_base):
+    """Recalculates keyword scores of the given rows of key_data."""
+    rows = sorted(rows)
+    subset = KeyDataStore()
+    subset.extend([key_data.keys[i] for i in rows],
+        *[[getattr(key_data, column)[i] for i in rows] for column in
+        ('traffic', 'iphone_diff', 'iphone_apps', 'ipad_diff', 'ipad_apps')])
+    calc_key_scores(subset, w_factors, apps_base, keylen_base)
+
+    if len(key_data.scores) < len(key_data.keys):
+        # Scores of added keys
+        key_data.scores.extend([0.0] * (len(key_data.keys) -
+            len(key_data.scores)))
+    for (i, score) in zip(rows, subset.scores):
+        key_data.scores[i] = score
+
+def print_cache_stats(cache):
+    """Prints hit/miss stats of a KeylistCache and saves them."""
+    if cache is None:
+        return
+    totals = cache.save_stats()
+    print("Keylist cache: %d hits, %d misses, %d evictions (total %d hits, "
+        "%d misses, %d evictions)" % (cache.stats['hits'],
+        cache.stats['misses'], cache.stats['evictions'], totals['hits'],
+        totals['misses'], totals['evictions']))
+
+def run_batch_task(task):
+    """Runs selection of one batch group, see process_batch.
+
+    Returns:
+        A tuple (group, best keylists, error message).
+    """
+    (group, key_data, keypair_data, settings) = task
+    try:
+        # Read in input files of manifest entries in the worker
+        if isinstance(key_data, str):
+            key_data = read_in_keydata(key_data)
+            keypair_data = (read_in_keydata(keypair_data) if keypair_data
+                else KeyDataStore())
+
+        if not key_data.keys:
+            return (group, [], "No input keywords")
+
+        # In case no dual key permutations available, skip
+        include_dual_keys = (settings['include_dual_keys'] and
+            bool(keypair_data.keys))
+
+        best_keylists = process(key_data, keypair_data, include_dual_keys,
+            settings['max_keylist_len'], settings['min_keylist_len'],
+            settings['w_factors'], settings['apps_base'],
+            settings['keylen_base'], settings['method'], settings['top_k'],
+            False, 1, settings['time_budget'], settings['seed'],
+            settings.get('cache'))
+        if not best_keylists:
+            return (group, [], "No keylist found")
+        return (group, best_keylists, "")
+    except Exception as e:
+        return (group, [], "%s: %s" % (type(e).__name__, e))
+
+def run_batch_worker(task):
+    """Runs run_batch_task in a worker process.
+
+    The keylist cache of a worker is a copy of the cache of the parent
+    process, so its hit/miss stats are returned to be added to the parent's.
+
+    Returns:
+        A tuple (result of run_batch_task, dict of cache stats of the task).
+    """
+    cache = task[3].get('cache')
+    start_stats = dict(cache.stats) if cache is not None else {}
+    result = run_batch_task(task)
+    stats = {name: count - start_stats[name] for (name, count) in
+        cache.stats.items()} if cache is not None else {}
+    return (result, stats)
+
+def process_batch(tasks, settings, workers=1, file="out_batch_results.csv",
+                  errors=None):
+    """Runs the keyword selection of many locales and apps.
+
+    Selections of all groups run in a pool of worker processes and are
+    written to one consolidated results file. A failing group is reported in
+    the results file and does not abort the batch.
+
+    Args:
+        tasks: A list of (group, key_data, keypair_data) tuples, where group
+            is a (lang, app) tuple and key_data and keypair_data are either
+            KeyDataStore objects or input file names.
+        settings: Dict of process arguments (include_dual_keys,
+            max_keylist_len, min_keylist_len, w_factors, apps_base,
+            keylen_base, method, top_k, time_budget, seed, cache). Cache
+            stats of worker processes are added to the stats of cache.
+        workers: Number of worker processes.
+        file: Name of output file.
+        errors: Dict of error messages of groups that failed beforehand, e.g.
+            while reading in data (optional).
+
+    Returns:
+        A list of (group, best keylists, error message) tuples.
+    """
+
+    tasks = [(group, key_data, keypair_data, settings) for
+        (group, key_data, keypair_data) in tasks]
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            results = []
+            for (result, stats) in pool.map(run_batch_worker, tasks,
+                    chunksize=1):
+                results.append(result)
+                for (name, count) in stats.items():
+                    settings['cache'].stats[name] += count
+    else:
+        results = [run_batch_task(task) for task in tasks]
+    if errors:
+        results += [(group, [], error) for (group, error) in
+            sorted(errors.items())]
+
+    with open(file, 'w', newline='', encoding='utf8') as csvfile:
+        csvwriter = csv.writer(csvfile, delimiter=';', quoting=csv.QUOTE_NONE,
+            escapechar='\\')
+
+        csvwriter.writerow(['lang', 'app', 'rank', 'keylist', 'score',
+            'length', 'words', 'error'])
+        for ((lang, app), best_keylists, error) in results:
+            if error:
+                csvwriter.writerow([lang, app, '', '', '', '', '', error])
+            for rank, (key_list, score) in enumerate(best_keylists, 1):
+                keylist = ",".join(key_list)
+                csvwriter.writerow([lang, app, rank, keylist, score,
+                    len(keylist), len(key_list), ''])
+
+    failed = sum(1 for result in results if result[2])
+    print("Batch of %d groups done, %d failed. Results exported to file: %s"
+        % (len(results), failed, file))
+
+    return results
+
+class MemoryKeylistCache(object):
+    """Object to keep candidate keylists of recent requests in memory.
+
+    Same interface as KeylistCache, holding the bitmasks of the max_entries
+    most recently used (keys, max_keylist_len, min_keylist_len) in memory,
+    backed by an optional KeylistCache on disk.
+    """
+
+    def __init__(self, max_entries=16, cache=None):
+        self.max_entries = max_entries
+        self.cache = cache
+        self.entries = collections.OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get_masks(self, keys, max_keylist_len, min_keylist_len):
+        """Returns all candidate keylists of keys as bitmasks."""
+        entry = (tuple(keys), max_keylist_len, min_keylist_len)
+        masks = self.entries.get(entry)
+        if masks is not None:
+            self.stats['hits'] += 1
+            self.entries.move_to_end(entry)
+            return masks
+
+        self.stats['misses'] += 1
+        masks = get_keylist_masks(keys, max_keylist_len, min_keylist_len,
+            self.cache)
+        self.entries[entry] = masks
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats['evictions'] += 1
+        return masks
+
+class ThreadOutput(object):
+    """Stream forwarding all writes to stream, except those of muted threads.
+
+    Replaces sys.stdout once, so prints of muted threads are dropped without
+    swapping sys.stdout while other threads write to it.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def mute(self):
+        """Drops all writes of the calling thread."""
+        self.local.muted = True
+
+    def write(self, text):
+        if getattr(self.local, 'muted', False):
+            return len(text)
+        return self.stream.write(text)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class SelectionService(object):
+    """Object to answer selection requests with warm in-memory data.
+
+    Keyword and key pair data are read in once per pair of input files and
+    kept in memory (read in again if an input file changed), as well as the
+    candidate keylists of recent requests. Requests are queued and run one
+    batch at a time by a worker thread: all requests queued within
+    batch_window seconds that share input files, length limits and
+    include_dual_keys are answered with one weight sweep over one set of
+    candidate keylists if they ask for the best keylist only, other requests
+    are run with process.
+
+    A request is a dict with keys key_data, keypair_data, max_keylist_len,
+    min_keylist_len, w_factors, apps_base, keylen_base, include_dual_keys,
+    method and top_k, missing keys take the defaults of the service.
+    Requests may only name the input files of the defaults or files within
+    data_dir, and only input files of the defaults are read in from and
+    stored as snapshots (see read_in_keydata). Output printed while running
+    requests is dropped unless verbose is set.
+    """
+
+    def __init__(self, defaults, batch_window=0.01, cache=None,
+                 verbose=False, data_dir=""):
+        self.defaults = defaults
+        self.batch_window = batch_window
+        self.verbose = verbose
+        self.data_files = {defaults['key_data'], defaults['keypair_data']}
+        self.data_dir = os.path.realpath(data_dir) if data_dir else ""
+        if not verbose and not isinstance(sys.stdout, ThreadOutput):
+            sys.stdout = ThreadOutput(sys.stdout)
+        self.cache = MemoryKeylistCache(cache=cache)
+        self.datasets = {}
+        self.requests = queue.Queue()
+        self.stats = {'requests': 0, 'batches': 0, 'errors': 0}
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def select(self, request):
+        """Queues a request and waits for its response.
+
+        Returns:
+            A response dict with ranked keylists or an error message.
+        """
+        (done, response) = (threading.Event(), {})
+        self.requests.put((request, done, response))
+        done.wait()
+        return response
+
+    def get_dataset(self, key_file, keypair_file):
+        """Returns key and key pair data of input files, reads in on change."""
+        stamp = []
+        for file in (key_file, keypair_file):
+            stat = os.stat(file)
+            stamp.append((stat.st_size, stat.st_mtime_ns))
+        dataset = self.datasets.get((key_file, keypair_file))
+        if dataset is None or dataset[0] != stamp:
+            dataset = (stamp, read_in_keydata(key_file, key_file in
+                self.data_files), read_in_keydata(keypair_file, keypair_file
+                in self.data_files))
+            self.datasets[(key_file, keypair_file)] = dataset
+        return dataset[1:]
+
+    def run(self):
+        """Runs queued requests in batches."""
+        if not self.verbose:
+            sys.stdout.mute()
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.perf_counter() + self.batch_window
+            while True:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            self.stats['batches'] += 1
+            self.stats['requests'] += len(batch)
+            self.run_batch(batch)
+            for (request, done, response) in batch:
+                if 'error' in response:
+                    self.stats['errors'] += 1
+                done.set()
+
+    def run_batch(self, batch):
+        """Groups a batch of requests by shared data and runs all groups."""
+        groups = collections.OrderedDict()
+        start_time = time.perf_counter()
+        for (request, done, response) in batch:
+            try:
+                settings = self.get_settings(request)
+            except (KeyError, TypeError, ValueError) as e:
+                response['error'] = "Invalid request. %s" % e
+                response['elapsed'] = time.perf_counter() - start_time
+                continue
+            group = (settings['key_data'], settings['keypair_data'],
+                settings['max_keylist_len'], settings['min_keylist_len'],
+                settings['include_dual_keys'])
+            groups.setdefault(group, []).append((settings, response,
+                start_time))
+
+        for (group, requests) in groups.items():
+            try:
+                self.run_group(requests)
+            except Exception as e:
+                for (settings, response, start_time) in requests:
+                    response['error'] = "%s: %s" % (type(e).__name__, e)
+            for (settings, response, start_time) in requests:
+                response['batch_size'] = len(requests)
+                response['elapsed'] = time.perf_counter() - start_time
+
+    def get_settings(self, request):
+        """Returns request merged with defaults, raises on invalid values."""
+        unknown = set(request) - set(self.defaults)
+        if unknown:
+            raise KeyError("Unknown settings %s" % ", ".join(sorted(unknown)))
+        settings = dict(self.defaults, **request)
+        for name in ('key_data', 'keypair_data'):
+            settings[name] = self.get_data_file(settings[name])
+        w_factors = dict(self.defaults['w_factors'],
+            **settings['w_factors'])
+        settings['w_factors'] = dict((w, float(w_factors[w])) for w in
+            ('w_diff', 'w_traffic', 'w_apps', 'w_keylen'))
+        if not math.isclose(sum(settings['w_factors'].values()), 1):
+            raise ValueError("Factor weights don't add up to 100%.")
+        for name in ('max_keylist_len', 'min_keylist_len', 'top_k'):
+            settings[name] = int(settings[name])
+        for name in ('apps_base', 'keylen_base'):
+            settings[name] = float(settings[name])
+        settings['include_dual_keys'] = bool(settings['include_dual_keys'])
+        if settings['method'] not in ('exhaustive', 'branch_bound', 'anneal'):
+            raise ValueError("Unknown method '%s'" % settings['method'])
+        return settings
+
+    def get_data_file(self, file):
+        """Returns name of a requested input file, raises if not allowed."""
+        if file in self.data_files:
+            return file
+        if self.data_dir:
+            path = os.path.realpath(os.path.join(self.data_dir, file))
+            if os.path.commonpath([path, self.data_dir]) == self.data_dir:
+                return path
+        raise ValueError("Input file '%s' not allowed" % file)
+
+    def run_group(self, requests):
+        """Runs requests sharing input files, limits and include_dual_keys."""
+        settings = requests[0][0]
+        (key_data, keypair_data) = self.get_dataset(settings['key_data'],
+            settings['keypair_data'])
+        if not key_data.keys:
+            raise ValueError("No input keywords")
+        include_dual_keys = (settings['include_dual_keys'] and
+            bool(keypair_data.keys))
+
+        sweep = [(settings, response) for (settings, response, start_time) in
+            requests if settings['top_k'] == 1 and
+            settings['method'] == 'exhaustive']
+        if len(sweep) > 1:
+            # Answer all requests with one enumeration of candidate keylists
+            results = sweep_weights(key_data, keypair_data, include_dual_keys,
+                settings['max_keylist_len'], settings['min_keylist_len'],
+                [dict(settings['w_factors'], apps_base=settings['apps_base'],
+                keylen_base=settings['keylen_base']) for (settings, response)
+                in sweep], cache=self.cache)
+            for ((settings, response), result) in itertools.zip_longest(
+                    sweep, results, fillvalue=(None, [], 0, False)):
+                (setting, keylist, score, changed) = result
+                set_response(response, [(keylist, score)] if keylist else [])
+        else:
+            sweep = []
+
+        swept = set(id(response) for (settings, response) in sweep)
+        for (settings, response, start_time) in requests:
+            if id(response) in swept:
+                continue
+            set_response(response, process(key_data, keypair_data,
+                include_dual_keys, settings['max_keylist_len'],
+                settings['min_keylist_len'], settings['w_factors'],
+                settings['apps_base'], settings['keylen_base'],
+                settings['method'], settings['top_k'],
+                time_budget=settings['time_budget'], seed=settings['seed'],
+                cache=self.cache))
+
+def set_response(response, best_keylists):
+    """Stores ranked keylists in a response of SelectionService."""
+    if best_keylists:
+        response['keylists'] = [{'keylist': keylist, 'score': score,
+            'length': len(",".join(keylist))} for (keylist, score) in
+            best_keylists]
+    else:
+        response['error'] = "No keylist found"
+
+class SelectionRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Handles json requests of a SelectionService.
+
+    POST /select with a json request (see SelectionService) returns the
+    ranked keylists, GET /status returns loaded data and stats.
+    """
+
+    def do_POST(self):
+        if self.path != '/select':
+            self.send_json(404, {'error': "Not found"})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            if not isinstance(request, dict):
+                raise ValueError("Request is no json object")
+        except ValueError as e:
+            self.send_json(400, {'error': "Invalid request. %s" % e})
+            return
+
+        response = self.server.service.select(request)
+        self.send_json(400 if 'error' in response else 200, response)
+
+    def do_GET(self):
+        if self.path != '/status':
+            self.send_json(404, {'error': "Not found"})
+            return
+        service = self.server.service
+        self.send_json(200, {'stats': service.stats,
+            'cache': service.cache.stats,
+            'datasets': [{'key_data': key_file, 'keypair_data': keypair_file,
+                'keys': len(key_data.keys), 'keypairs': len(keypair_data.keys)}
+                for ((key_file, keypair_file), (stamp, key_data,
+                keypair_data)) in list(service.datasets.items())]})
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Requests are not logged
+        pass
+
+class UnixHTTPServer(http.server.ThreadingHTTPServer):
+    """HTTP server listening on a Unix socket."""
+
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        socketserver.TCPServer.server_bind(self)
+        (self.server_name, self.server_port) = ("localhost", 0)
+
+def serve(address, service):
+    """Runs a SelectionService as HTTP server until interrupted.
+
+    Args:
+        address: host:port to listen on, or unix:path for a Unix socket.
+        service: SelectionService object.
+    """
+    if address.startswith("unix:"):
+        path = address[len("unix:"):]
+        if os.path.exists(path):
+            os.remove(path)
+        server = UnixHTTPServer(path, SelectionRequestHandler)
+    else:
+        (host, port) = address.rsplit(":", 1)
+        server = http.server.ThreadingHTTPServer((host, int(port)),
+            SelectionRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+
+    print("Serving keyword selections on %s (POST /select, GET /status)"
+        % address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if address.startswith("unix:"):
+            os.remove(path)
 
 if __name__ == '__main__':
     import argparse
@@ -492,22 +3767,115 @@ if __name__ == '__main__':
                         default='in_sample_keypair_metrics.csv',
                         help="Key pair data for dual key permutation search " \
                             "phrase computation")
-    parser.add_argument("--max_keylist_len", default=100, 
+    parser.add_argument("--max_keylist_len", default=100, type=int,
                         help="Max char length of keyword list")
-    parser.add_argument("--min_keylist_len", default=90,
+    parser.add_argument("--min_keylist_len", default=90, type=int,
                         help="Min char length of keyword list")
     # Default value calculated as average of number of apps of the keys used by
     # the top 200 free apps
-    parser.add_argument("--apps_base", default=3500,
+    parser.add_argument("--apps_base", default=3500, type=float,
                         help="Used to normalize score of number of apps factor")
     # Default value calculated as average keylength of the keys used by
     # the top 200 free apps
-    parser.add_argument("--keylen_base", default=6,
+    parser.add_argument("--keylen_base", default=6, type=float,
                         help="Used to normalize score of keylength factor")
     parser.add_argument("--include_dual_keys", default=True,
                         help="Include score of dual key combinations to " \
                             "determine best keyword list")
-                        
+    parser.add_argument("--method", default="exhaustive",
+                        choices=["exhaustive", "branch_bound", "anneal"],
+                        help="Score all keyword combinations, search best " \
+                            "keyword list with branch-and-bound or search a " \
+                            "good keyword list with simulated annealing")
+    parser.add_argument("--time_budget", default=10, type=float,
+                        help="Search time in seconds of method anneal")
+    parser.add_argument("--seed", default=None, type=int,
+                        help="Random seed of method anneal")
+    parser.add_argument("--no_snapshot", action="store_true",
+                        help="Don't read or write binary snapshots of the " \
+                            "input files")
+    parser.add_argument("--select_keypairs", default="",
+                        choices=["", "stream", "index"],
+                        help="Only read in key pairs of the input keys, by " \
+                            "streaming the key pair data or looking them " \
+                            "up in a sorted index of it")
+    parser.add_argument("--count_only", action="store_true",
+                        help="Only count candidate keyword lists, to " \
+                            "predict run time of a selection")
+    parser.add_argument("--top_k", default=1, type=int,
+                        help="Number of highest scoring keyword lists to " \
+                            "report")
+    parser.add_argument("--dump_files", action="store_true",
+                        help="Export all keyword lists and scores to out_*.csv")
+    parser.add_argument("--outputs", default="",
+                        help="Comma separated output files to export (%s), " \
+                            "implies --dump_files" % ", ".join(OUTPUT_FILES))
+    parser.add_argument("--output_format", default="csv",
+                        choices=OUTPUT_FORMATS,
+                        help="Format of output files: csv, gzip compressed " \
+                            "csv or binary columnar tables")
+    parser.add_argument("--workers", default=1, type=int,
+                        help="Number of worker processes to enumerate and " \
+                            "score keyword lists (or to run batch groups)")
+    parser.add_argument("--batch", default="",
+                        help="Run selections of all lang/app groups of " \
+                            "combined key data file (with --keypair_data as " \
+                            "combined key pair data file)")
+    parser.add_argument("--manifest", default="",
+                        help="Run selections of all key/keypair data file " \
+                            "pairs listed in manifest file")
+    parser.add_argument("--batch_output", default="out_batch_results.csv",
+                        help="Results file of batch selections")
+    parser.add_argument("--sweep", default="",
+                        help="Determine best keyword list for each weight " \
+                            "setting (w_diff, w_traffic, w_apps, w_keylen, " \
+                            "apps_base, keylen_base) of csv file")
+    parser.add_argument("--sweep_output", default="out_sweep.csv",
+                        help="Results file of weight sweep")
+    parser.add_argument("--what_if", default="",
+                        help="Calculate the score gain of adding each " \
+                            "candidate keyword of csv file to the best (or " \
+                            "--keylist) keyword list")
+    parser.add_argument("--what_if_keypairs", default="",
+                        help="Key pair data of the --what_if candidates")
+    parser.add_argument("--keylist", default="",
+                        help="Comma separated keyword list to evaluate " \
+                            "--what_if candidates against")
+    parser.add_argument("--what_if_output", default="out_what_if.csv",
+                        help="Results file of --what_if candidates")
+    parser.add_argument("--state", default="",
+                        help="Selection state file, created from the input " \
+                            "files if missing, and kept up to date with " \
+                            "--key_delta/--keypair_delta")
+    parser.add_argument("--key_delta", default="",
+                        help="Changed keyword data to apply to --state")
+    parser.add_argument("--keypair_delta", default="",
+                        help="Changed key pair data to apply to --state")
+    parser.add_argument("--cache_dir", default="",
+                        help="Directory to cache candidate keyword lists in")
+    parser.add_argument("--cache_size", default=256, type=float,
+                        help="Maximum size of keyword list cache in MB")
+    parser.add_argument("--serve", default="",
+                        help="Run as selection service on host:port or " \
+                            "unix:path, answering json requests")
+    parser.add_argument("--batch_window", default=10, type=float,
+                        help="Time in ms to batch requests of the selection " \
+                            "service")
+    parser.add_argument("--data_dir", default="",
+                        help="Directory of input files requests of the " \
+                            "selection service may name besides " \
+                            "--key_data and --keypair_data")
+    parser.add_argument("--verbose", action="store_true",
+                        help="Print output of selections run by the " \
+                            "selection service")
+    parser.add_argument("--metrics", default="",
+                        help="Export run time, memory and counters of all " \
+                            "stages as json to file ('-' to log them)")
+    parser.add_argument("--trace_memory", action="store_true",
+                        help="Trace peak memory of all stages (slow)")
+    parser.add_argument("--profile", default="",
+                        help="Export cProfile stats of all stages to file")
+
     args = parser.parse_args()
 
     # Start main procedure
@@ -517,15 +3885,115 @@ if __name__ == '__main__':
     w_factors = {'w_diff':0.55, 'w_traffic':0.35, 
                 'w_apps':0.05, 'w_keylen':0.05}
 
+    cache = (KeylistCache(args.cache_dir, int(args.cache_size * (1 << 20)))
+        if args.cache_dir else None)
+
+    if args.serve:
+        defaults = {'key_data': args.key_data,
+            'keypair_data': args.keypair_data,
+            'max_keylist_len': args.max_keylist_len,
+            'min_keylist_len': args.min_keylist_len, 'w_factors': w_factors,
+            'apps_base': args.apps_base, 'keylen_base': args.keylen_base,
+            'include_dual_keys': bool(args.include_dual_keys),
+            'method': args.method, 'top_k': args.top_k,
+            'time_budget': args.time_budget, 'seed': args.seed}
+        serve(args.serve, SelectionService(defaults,
+            args.batch_window / 1000, cache, args.verbose, args.data_dir))
+        sys.exit()
+
+    if args.batch or args.manifest:
+        settings = {'include_dual_keys': args.include_dual_keys,
+            'max_keylist_len': args.max_keylist_len,
+            'min_keylist_len': args.min_keylist_len, 'w_factors': w_factors,
+            'apps_base': args.apps_base, 'keylen_base': args.keylen_base,
+            'method': args.method, 'top_k': args.top_k,
+            'time_budget': args.time_budget, 'seed': args.seed,
+            'cache': cache}
+
+        errors = {}
+        if args.manifest:
+            tasks = read_in_manifest(args.manifest)
+        else:
+            # Group combined key and key pair data by lang and app
+            (key_groups, errors) = read_in_grouped_keydata(args.batch)
+            (keypair_groups, keypair_errors) = read_in_grouped_keydata(
+                args.keypair_data)
+            for (group, error) in keypair_errors.items():
+                if group in key_groups:
+                    del key_groups[group]
+                    errors[group] = "Key pair data: " + error
+            tasks = [(group, key_groups[group], keypair_groups.get(group,
+                KeyDataStore())) for group in sorted(key_groups)]
+
+        process_batch(tasks, settings, args.workers, args.batch_output,
+            errors)
+        print_cache_stats(cache)
+
+        print("Elapsed time: ", time.time() - start_time, "seconds")
+        sys.exit()
+
+    if args.state:
+        state = SelectionState.load(args.state)
+        if state is None:
+            key_data = read_in_keydata(args.key_data, not args.no_snapshot)
+            keypair_data = read_in_keydata(args.keypair_data,
+                not args.no_snapshot)
+            state = SelectionState(key_data, keypair_data,
+                args.include_dual_keys and bool(keypair_data.keys),
+                args.max_keylist_len, args.min_keylist_len, w_factors,
+                args.apps_base, args.keylen_base, args.top_k, cache)
+        else:
+            state.cache = cache
+            state.set_settings(args.max_keylist_len, args.min_keylist_len,
+                args.include_dual_keys and bool(state.keypair_data.keys),
+                w_factors, args.apps_base, args.keylen_base, args.top_k)
+
+        if args.key_delta or args.keypair_delta:
+            state.apply_delta(read_in_keydata(args.key_delta, False)
+                if args.key_delta else KeyDataStore(),
+                read_in_keydata(args.keypair_delta, False)
+                if args.keypair_delta else KeyDataStore())
+        state.save(args.state)
+
+        for rank, (keylist, score) in enumerate(state.best_keylists, 1):
+            print("%d. (%s) with %.2f points" % (rank, ','.join(keylist),
+                score))
+        print_cache_stats(cache)
+
+        print("Elapsed time: ", time.time() - start_time, "seconds")
+        sys.exit()
+
+    metrics = (Metrics(args.trace_memory, bool(args.profile))
+        if args.metrics or args.profile else None)
+
+    outputs = None
+    if args.outputs:
+        outputs = args.outputs.split(",")
+        for name in outputs:
+            if name not in OUTPUT_FILES:
+                parser.error("Unknown output file '%s'" % name)
+
     # Read in keyword data
-    key_data = read_in_keydata(args.key_data)
+    with measure_stage(metrics, 'read_in_keydata'):
+        key_data = read_in_keydata(args.key_data, not args.no_snapshot)
 
     if not key_data.keys:
         # No input keywords
         print("Error: Please check input file and keywords.")
+    elif args.count_only:
+        for (cost, positions) in get_length_buckets(key_data.keys):
+            print("Key length %d: %d keys" % (cost - 1, len(positions)))
+        print("Candidate keylists: %d" % count_keylists(key_data.keys,
+            args.max_keylist_len, args.min_keylist_len))
     else:
         # Read in dual keyword permutation data
-        keypair_data = read_in_keydata(args.keypair_data)
+        with measure_stage(metrics, 'read_in_keydata'):
+            if args.select_keypairs:
+                keypair_data = read_in_keypair_data(args.keypair_data,
+                    key_data.keys, args.select_keypairs == "index")
+            else:
+                keypair_data = read_in_keydata(args.keypair_data,
+                    not args.no_snapshot)
         
         if not keypair_data.keys:
             # In case no  dual key permutations available, skip
@@ -533,8 +4001,62 @@ if __name__ == '__main__':
             print("Error: No dual keyword permutations found. Skipping ", 
                 "score calculation step for dual key permutations.")
 
-        process(key_data, keypair_data, args.include_dual_keys, 
-                args.max_keylist_len, args.min_keylist_len, 
-                w_factors, args.apps_base, args.keylen_base)
+        if args.sweep:
+            defaults = dict(w_factors, apps_base=args.apps_base,
+                keylen_base=args.keylen_base)
+            settings = read_in_sweep_settings(args.sweep, defaults)
+            results = sweep_weights(key_data, keypair_data,
+                args.include_dual_keys, args.max_keylist_len,
+                args.min_keylist_len, settings, args.sweep_output, cache)
+            for (setting, keylist, score, changed) in results:
+                print("%s%s: (%s) with %.2f points" % ("* " if changed else
+                    "  ", setting, ','.join(keylist), score))
+        elif args.what_if:
+            if args.keylist:
+                key_list = args.keylist.split(",")
+                calc_key_scores(key_data, w_factors, args.apps_base,
+                    args.keylen_base)
+                calc_key_scores(keypair_data, w_factors, args.apps_base,
+                    args.keylen_base)
+            else:
+                best_keylists = process(key_data, keypair_data,
+                    args.include_dual_keys, args.max_keylist_len,
+                    args.min_keylist_len, w_factors, args.apps_base,
+                    args.keylen_base, args.method, 1, False, args.workers,
+                    args.time_budget, args.seed, cache)
+                key_list = best_keylists[0][0] if best_keylists else []
+            candidates = read_in_keydata(args.what_if, False)
+            calc_key_scores(candidates, w_factors, args.apps_base,
+                args.keylen_base)
+            candidate_pairs = None
+            if args.what_if_keypairs:
+                candidate_pairs = read_in_keydata(args.what_if_keypairs,
+                    False)
+                calc_key_scores(candidate_pairs, w_factors, args.apps_base,
+                    args.keylen_base)
+            results = calc_marginal_gains(key_list, key_data, keypair_data,
+                candidates, args.include_dual_keys, args.max_keylist_len,
+                candidate_pairs, args.what_if_output)
+            for (key, key_score, pair_score, dropped, keylist, score,
+                    gain) in results:
+                print("%+.4f %s%s: (%s) with %.2f points" % (gain, key,
+                    " for " + ",".join(dropped) if dropped else "",
+                    ",".join(keylist), score))
+        else:
+            process(key_data, keypair_data, args.include_dual_keys, 
+                    args.max_keylist_len, args.min_keylist_len, 
+                    w_factors, args.apps_base, args.keylen_base, args.method,
+                    args.top_k, args.dump_files or bool(outputs), args.workers,
+                    args.time_budget, args.seed, cache, metrics, outputs,
+                    args.output_format)
+        print_cache_stats(cache)
+
+    if args.metrics == '-':
+        logging.basicConfig(level=logging.INFO, format="%(message)s")
+        metrics.log()
+    elif args.metrics:
+        metrics.write(args.metrics)
+    if args.profile:
+        metrics.dump_profile(args.profile)
 
     print("Elapsed time: ", time.time() - start_time, "seconds")
\ No newline at end of file
@@ -0,0 +1,472 @@
+"""
+    Reference tests of the keyword selection script.
+
+    Compares the selection paths of process and the other entry points of
+    the script with brute force results, e.g. the original exhaustive
+    enumeration of all keyword combinations, on seeded synthetic data (see
+    benchmark.generate_keydata).
+
+    Run with: python -m unittest test_keylist_selector
+
+    :copyright: (c) 2014 by Szilard Szasz-Toth.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import contextlib
+import csv
+import io
+import itertools
+import math
+import os
+import tempfile
+import unittest
+
+import benchmark
+import keylist_selector as ks
+
+W_FACTORS = {'w_diff':0.55, 'w_traffic':0.35, 'w_apps':0.05, 'w_keylen':0.05}
+APPS_BASE = 3500
+KEYLEN_BASE = 6
+
+# (number of keys, seed, max_keylist_len, min_keylist_len)
+CASES = [(8, 1, 30, 20), (11, 2, 40, 30), (12, 3, 50, 35)]
+
+def read_in_data(n_keys, seed):
+    """Returns keyword and key pair data of a synthetic data set."""
+    with tempfile.TemporaryDirectory() as data_dir:
+        key_file = os.path.join(data_dir, 'keys.csv')
+        keypair_file = os.path.join(data_dir, 'keypairs.csv')
+        benchmark.generate_keydata(n_keys, seed, key_file, keypair_file)
+        with contextlib.redirect_stdout(io.StringIO()):
+            return (ks.read_in_keydata(key_file, False),
+                ks.read_in_keydata(keypair_file, False))
+
+def get_infeasible_data():
+    """Returns keyword data without any keylist of 8 to 10 chars."""
+    key_data = ks.KeyDataStore()
+    keypair_data = ks.KeyDataStore()
+    for key in ("aaaaaa", "bbbbbb", "cccccc"):
+        key_data.add_key(key, 5, 5, 1000, 5, 1000)
+    for (key1, key2) in itertools.permutations(key_data.keys, 2):
+        keypair_data.add_key(key1 + " " + key2, 5, 5, 1000, 5, 1000)
+    return (key_data, keypair_data)
+
+def select_exhaustive(key_data, keypair_data, max_keylist_len,
+                      min_keylist_len):
+    """Scores all keyword combinations as the original script did.
+
+    Enumerates all combinations within the length limits, removes subsets
+    of other combinations and scores them key by key.
+
+    Returns:
+        A list of (sorted keylist, cumulative score) tuples, highest score
+        first.
+    """
+    keys = key_data.keys
+    if len(",".join(keys)) > max_keylist_len:
+        combinations = [set(c) for i in range(len(keys) + 1) for c in
+            itertools.combinations(keys, i) if min_keylist_len <=
+            len(",".join(c)) <= max_keylist_len]
+        key_lists = [sorted(c) for c in combinations if not any(c < other
+            for other in combinations)]
+    else:
+        key_lists = [sorted(keys)]
+
+    results = [(key_list, score_exhaustive(key_list, key_data, keypair_data,
+        max_keylist_len)) for key_list in key_lists]
+    results.sort(key=lambda result: -result[1])
+    return results
+
+def score_exhaustive(key_list, key_data, keypair_data, max_keylist_len):
+    """Returns cumulative score of a keylist, looked up key by key."""
+
+    def get_score(key, key_data):
+        if key not in key_data.keys:
+            return -99
+        return key_data.scores[key_data.keys.index(key)]
+
+    max_keys = max_keylist_len/2
+    key_scores = [get_score(key, key_data) for key in key_list]
+    key_score = -99 if min(key_scores) < 0 else sum(key_scores)
+    pair_scores = [get_score(key1 + " " + key2, keypair_data) for
+        (key1, key2) in itertools.permutations(key_list, 2)]
+    pair_score = -99 if pair_scores and min(pair_scores) < 0 else \
+        sum(pair_scores)
+    return (2/3 * key_score/(max_keylist_len/2 * 10) +
+        1/3 * pair_score/(max_keys * (max_keys-1) * 10))
+
+def get_reference(n_keys, seed, max_keylist_len, min_keylist_len,
+                  w_factors=W_FACTORS, apps_base=APPS_BASE,
+                  keylen_base=KEYLEN_BASE):
+    """Returns select_exhaustive results of a synthetic data set."""
+    (key_data, keypair_data) = read_in_data(n_keys, seed)
+    ks.calc_key_scores(key_data, w_factors, apps_base, keylen_base)
+    ks.calc_key_scores(keypair_data, w_factors, apps_base, keylen_base)
+    return select_exhaustive(key_data, keypair_data, max_keylist_len,
+        min_keylist_len)
+
+def run_process(key_data, keypair_data, max_keylist_len, min_keylist_len,
+                **kwargs):
+    """Runs process with the default score settings, without output."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        return ks.process(key_data, keypair_data, True, max_keylist_len,
+            min_keylist_len, W_FACTORS, APPS_BASE, KEYLEN_BASE, **kwargs)
+
+class KeylistTestCase(unittest.TestCase):
+
+    def assertKeylistsEqual(self, keylists, expected):
+        """Compares (keylist, score) tuples with select_exhaustive results."""
+        self.assertEqual([sorted(key_list) for (key_list, score) in
+            keylists], [key_list for (key_list, score) in expected])
+        for ((key_list, score), (expected_list, expected_score)) in zip(
+                keylists, expected):
+            self.assertTrue(math.isclose(score, expected_score,
+                rel_tol=1e-9), (key_list, score, expected_score))
+
+class ReferenceTest(KeylistTestCase):
+    """Compares selection paths with the original exhaustive enumeration."""
+
+    def test_process(self):
+        for (n_keys, seed, max_len, min_len) in CASES:
+            with self.subTest(n_keys=n_keys):
+                expected = get_reference(n_keys, seed, max_len, min_len)
+                best_keylists = run_process(*read_in_data(n_keys, seed),
+                    max_len, min_len, top_k=5)
+                self.assertKeylistsEqual(best_keylists, expected[:5])
+
+    def test_workers(self):
+        for (n_keys, seed, max_len, min_len) in CASES:
+            with self.subTest(n_keys=n_keys):
+                serial = run_process(*read_in_data(n_keys, seed), max_len,
+                    min_len, top_k=5)
+                parallel = run_process(*read_in_data(n_keys, seed), max_len,
+                    min_len, top_k=5, workers=3)
+                self.assertEqual(parallel, serial)
+
+    def test_cache(self):
+        (n_keys, seed, max_len, min_len) = CASES[-1]
+        expected = get_reference(n_keys, seed, max_len, min_len)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ks.KeylistCache(cache_dir)
+            for run in range(2):
+                best_keylists = run_process(*read_in_data(n_keys, seed),
+                    max_len, min_len, top_k=5, cache=cache)
+                self.assertKeylistsEqual(best_keylists, expected[:5])
+            self.assertEqual((cache.stats['misses'], cache.stats['hits']),
+                (1, 1))
+
+    def test_branch_bound(self):
+        for (n_keys, seed, max_len, min_len) in CASES:
+            with self.subTest(n_keys=n_keys):
+                expected = get_reference(n_keys, seed, max_len, min_len)
+                best_keylists = run_process(*read_in_data(n_keys, seed),
+                    max_len, min_len, method="branch_bound")
+                self.assertKeylistsEqual(best_keylists, expected[:1])
+
+    def test_branch_bound_infeasible(self):
+        # Fails like the exhaustive search if no keylist fits
+        self.assertEqual(run_process(*get_infeasible_data(), 10, 8), [])
+        self.assertEqual(run_process(*get_infeasible_data(), 10, 8,
+            method="branch_bound"), [])
+
+class CountKeylistsTest(unittest.TestCase):
+    """Compares counted with generated candidate keylists."""
+
+    def test_count_keylists(self):
+        for (n_keys, seed) in ((8, 1), (12, 3), (16, 4)):
+            keys = read_in_data(n_keys, seed)[0].keys
+            for (max_len, min_len) in ((20, 0), (30, 20), (50, 35), (60, 59),
+                    (200, 0)):
+                with self.subTest(n_keys=n_keys, max_len=max_len,
+                        min_len=min_len):
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        expected = [len(list(ks.iter_keylist_masks(keys,
+                            max_len, min_len, bucketed=bucketed))) for
+                            bucketed in (False, True)]
+                    self.assertEqual(expected[0], expected[1])
+                    self.assertEqual(ks.count_keylists(keys, max_len,
+                        min_len), expected[0])
+
+class MetricsTest(unittest.TestCase):
+    """Compares counters of the default path with exhaustive enumeration."""
+
+    def test_counters(self):
+        for (n_keys, seed, max_len, min_len) in CASES:
+            with self.subTest(n_keys=n_keys):
+                expected = get_reference(n_keys, seed, max_len, min_len)
+                counters = []
+                for workers in (1, 3):
+                    metrics = ks.Metrics()
+                    run_process(*read_in_data(n_keys, seed), max_len,
+                        min_len, workers=workers, metrics=metrics)
+                    counters.append(metrics.counters)
+                self.assertEqual(counters[0], counters[1])
+
+                counters = counters[0]
+                self.assertEqual(counters['combinations_generated'],
+                    len(expected))
+                self.assertEqual(counters['keylists_scored'], len(expected))
+                self.assertEqual(counters['score_lookups'], sum(len(key_list)
+                    ** 2 for (key_list, score) in expected))
+                for name in ('rejected_by_length', 'removed_as_subsets'):
+                    self.assertIn(name, counters)
+
+class SweepTest(KeylistTestCase):
+    """Compares weight sweeps with exhaustive selections of each setting."""
+
+    def test_sweep_weights(self):
+        (n_keys, seed, max_len, min_len) = CASES[-1]
+        settings = [dict(W_FACTORS, apps_base=APPS_BASE,
+            keylen_base=KEYLEN_BASE)]
+        for w_diff in (0.1, 0.4, 0.7):
+            for apps_base in (100, 3500):
+                settings.append({'w_diff': w_diff, 'w_traffic':
+                    0.9 - w_diff, 'w_apps': 0.05, 'w_keylen': 0.05,
+                    'apps_base': apps_base, 'keylen_base': KEYLEN_BASE})
+        # Weights adding up to 1 within float tolerance, and not at all
+        settings.append({'w_diff': 0.7, 'w_traffic': 0.1, 'w_apps': 0.1,
+            'w_keylen': 0.1, 'apps_base': APPS_BASE, 'keylen_base': 4})
+        settings.append({'w_diff': 0.5, 'w_traffic': 0.5, 'w_apps': 0.5,
+            'w_keylen': 0, 'apps_base': APPS_BASE, 'keylen_base': 4})
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            file = os.path.join(data_dir, 'sweep.csv')
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = ks.sweep_weights(*read_in_data(n_keys, seed), True,
+                    max_len, min_len, settings, file)
+            with open(file, newline='', encoding='utf8') as csvfile:
+                errors = [row['error'] for row in csv.DictReader(csvfile,
+                    delimiter=';')]
+        self.assertEqual(errors[:-1], [""] * (len(settings) - 1))
+        self.assertTrue(errors[-1])
+        self.assertEqual(len(results), len(settings))
+        for (setting, key_list, score, changed) in results[:-1]:
+            with self.subTest(setting=setting):
+                w_factors = {name: setting[name] for name in W_FACTORS}
+                expected = get_reference(n_keys, seed, max_len, min_len,
+                    w_factors, setting['apps_base'], setting['keylen_base'])
+                self.assertKeylistsEqual([(key_list, score)], expected[:1])
+        self.assertFalse(results[-1][1])
+
+class MarginalGainsTest(unittest.TestCase):
+    """Compares what-if results with keylists scored key by key."""
+
+    def test_marginal_gains(self):
+        (n_keys, seed, max_len, min_len) = CASES[-1]
+        (key_data, keypair_data) = read_in_data(n_keys, seed)
+        ks.calc_key_scores(key_data, W_FACTORS, APPS_BASE, KEYLEN_BASE)
+        ks.calc_key_scores(keypair_data, W_FACTORS, APPS_BASE, KEYLEN_BASE)
+        key_list = select_exhaustive(key_data, keypair_data, max_len,
+            min_len)[0][0]
+        base_score = score_exhaustive(key_list, key_data, keypair_data,
+            max_len)
+
+        def score(key_list):
+            return score_exhaustive(key_list, key_data, keypair_data,
+                max_len)
+
+        def fits(key_list):
+            return len(",".join(key_list)) <= max_len
+
+        # Candidates are all other input keys
+        results = ks.calc_marginal_gains(key_list, key_data, keypair_data,
+            key_data, True, max_len)
+        self.assertEqual(sorted(key for (key, key_score, pair_score,
+            dropped, keylist, score, gain) in results), sorted(set(
+            key_data.keys) - set(key_list)))
+        for (key, key_score, pair_score, dropped, new_keylist, new_score,
+                gain) in results:
+            with self.subTest(key=key):
+                self.assertEqual(sorted(new_keylist + dropped), sorted(
+                    key_list + [key]))
+                self.assertTrue(fits(new_keylist))
+                self.assertTrue(math.isclose(new_score, score(new_keylist),
+                    rel_tol=1e-9))
+                self.assertTrue(math.isclose(gain, new_score - base_score,
+                    rel_tol=1e-9, abs_tol=1e-12))
+
+                # Each dropped key is the best choice of its step
+                kept = key_list[:]
+                for drop in dropped:
+                    options = [[k for k in kept if k != other] for other in
+                        kept]
+                    if any(fits(option + [key]) for option in options):
+                        options = [option for option in options if
+                            fits(option + [key])]
+                    best = max(score(option + [key]) for option in options)
+                    kept.remove(drop)
+                    self.assertTrue(math.isclose(score(kept + [key]), best,
+                        rel_tol=1e-9))
+
+class SelectionStateTest(unittest.TestCase):
+    """Compares SelectionState updates with a full rebuild."""
+
+    def get_state(self, key_data, keypair_data, max_len, min_len):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return ks.SelectionState(key_data, keypair_data, True, max_len,
+                min_len, W_FACTORS, APPS_BASE, KEYLEN_BASE, 5)
+
+    def assertStatesEqual(self, state, rebuilt):
+        self.assertEqual(list(state.masks), list(rebuilt.masks))
+        for (score, rebuilt_score) in zip(state.scores, rebuilt.scores):
+            self.assertTrue(math.isclose(score, rebuilt_score,
+                rel_tol=1e-9, abs_tol=1e-12))
+        self.assertEqual([key_list for (key_list, score) in
+            state.best_keylists], [key_list for (key_list, score) in
+            rebuilt.best_keylists])
+
+    def test_apply_delta(self):
+        (n_keys, seed, max_len, min_len) = CASES[-1]
+        (key_data, keypair_data) = read_in_data(n_keys, seed)
+        state = self.get_state(key_data, keypair_data, max_len, min_len)
+
+        # Change metrics of two keys and one key pair
+        keys = key_data.keys
+        key_delta = ks.KeyDataStore()
+        key_delta.add_key(keys[0], 9.5, 0.5, 10, 0.5, 10)
+        key_delta.add_key(keys[3], 0.5, 9.5, 100000, 9.5, 100000)
+        keypair_delta = ks.KeyDataStore()
+        keypair_delta.add_key(keys[1] + " " + keys[2], 9.5, 0.5, 10, 0.5, 10)
+        with contextlib.redirect_stdout(io.StringIO()):
+            state.apply_delta(key_delta, keypair_delta)
+
+        (key_data, keypair_data) = read_in_data(n_keys, seed)
+        with contextlib.redirect_stdout(io.StringIO()):
+            ks.update_keydata(key_data, key_delta)
+            ks.update_keydata(keypair_data, keypair_delta)
+        self.assertStatesEqual(state, self.get_state(key_data, keypair_data,
+            max_len, min_len))
+
+    def test_set_settings(self):
+        # Loaded states are rescored if any score setting changed
+        (n_keys, seed, max_len, min_len) = CASES[-1]
+        state = self.get_state(*read_in_data(n_keys, seed), max_len, min_len)
+        with contextlib.redirect_stdout(io.StringIO()):
+            state.set_settings(max_len, min_len, True, W_FACTORS, 100, 4, 5)
+            rebuilt = ks.SelectionState(*read_in_data(n_keys, seed), True,
+                max_len, min_len, W_FACTORS, 100, 4, 5)
+        self.assertStatesEqual(state, rebuilt)
+
+class SelectionServiceTest(KeylistTestCase):
+    """Checks input files and results of selection service requests."""
+
+    def test_data_files(self):
+        (n_keys, seed, max_len, min_len) = CASES[-1]
+        with tempfile.TemporaryDirectory() as temp_dir:
+            data_dir = os.path.join(temp_dir, 'data')
+            os.mkdir(data_dir)
+            key_file = os.path.join(data_dir, 'keys.csv')
+            keypair_file = os.path.join(data_dir, 'keypairs.csv')
+            benchmark.generate_keydata(n_keys, seed, key_file, keypair_file)
+            benchmark.generate_keydata(n_keys, seed, os.path.join(data_dir,
+                'more.csv'), os.path.join(data_dir, 'more_pairs.csv'))
+            other_file = os.path.join(temp_dir, 'other.csv')
+            benchmark.generate_keydata(n_keys, seed, other_file,
+                os.path.join(temp_dir, 'other_pairs.csv'))
+
+            defaults = {'key_data': key_file, 'keypair_data': keypair_file,
+                'max_keylist_len': max_len, 'min_keylist_len': min_len,
+                'w_factors': W_FACTORS, 'apps_base': APPS_BASE,
+                'keylen_base': KEYLEN_BASE, 'include_dual_keys': True,
+                'method': 'exhaustive', 'top_k': 1, 'time_budget': 1,
+                'seed': None}
+            expected = get_reference(n_keys, seed, max_len, min_len)
+            with contextlib.redirect_stdout(io.StringIO()):
+                service = ks.SelectionService(defaults, verbose=True)
+                responses = [service.select({}), service.select({'key_data':
+                    other_file}), service.select({'key_data': '../other.csv'})]
+                service = ks.SelectionService(defaults, verbose=True,
+                    data_dir=data_dir)
+                responses += [service.select({'key_data': 'more.csv',
+                    'keypair_data': 'more_pairs.csv'}), service.select({
+                    'key_data': '../other.csv'})]
+
+            for i in (0, 3):
+                self.assertKeylistsEqual([(keylist['keylist'],
+                    keylist['score']) for keylist in
+                    responses[i]['keylists']], expected[:1])
+            for i in (1, 2, 4):
+                self.assertIn("not allowed", responses[i]['error'])
+
+            # Snapshots of input files of the defaults only
+            self.assertEqual(sorted(os.listdir(data_dir)), ['keypairs.csv',
+                'keypairs.csv.kds', 'keys.csv', 'keys.csv.kds', 'more.csv',
+                'more_pairs.csv'])
+
+class AnnealTest(unittest.TestCase):
+    """Checks keylists found by simulated annealing."""
+
+    def test_anneal(self):
+        (n_keys, seed, max_len, min_len) = CASES[0]
+        best_keylists = run_process(*read_in_data(n_keys, seed), max_len,
+            min_len, method="anneal", time_budget=0.2, seed=1)
+        self.assertEqual(len(best_keylists), 1)
+        self.assertTrue(min_len <= len(",".join(best_keylists[0][0])) <=
+            max_len)
+
+    def test_anneal_infeasible(self):
+        self.assertEqual(run_process(*get_infeasible_data(), 10, 8,
+            method="anneal", time_budget=0.1, seed=1), [])
+
+class ReadInTest(unittest.TestCase):
+    """Compares read in keyword data with rows of the csv module."""
+
+    COLUMNS = ('traffic', 'iphone_diff', 'iphone_apps', 'ipad_diff',
+        'ipad_apps')
+
+    def read_in(self, file, use_snapshot=False):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return ks.read_in_keydata(file, use_snapshot)
+
+    def test_read_in_keydata(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            key_file = os.path.join(data_dir, 'keys.csv')
+            keypair_file = os.path.join(data_dir, 'keypairs.csv')
+            benchmark.generate_keydata(30, 1, key_file, keypair_file, 0.1)
+            with open(keypair_file, newline='', encoding='utf8') as csvfile:
+                rows = list(csv.DictReader(csvfile))
+
+            for use_snapshot in (True, True, False):
+                key_data = self.read_in(keypair_file, use_snapshot)
+                self.assertEqual(list(key_data.keys), [row['key'] for row in
+                    rows])
+                for column in self.COLUMNS:
+                    self.assertEqual(list(getattr(key_data, column)),
+                        [float(row[column]) for row in rows])
+            self.assertEqual(sorted(os.listdir(data_dir)), ['keypairs.csv',
+                'keypairs.csv.kds', 'keys.csv'])
+
+    def test_read_in_keypair_data(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            key_file = os.path.join(data_dir, 'keys.csv')
+            keypair_file = os.path.join(data_dir, 'keypairs.csv')
+            benchmark.generate_keydata(30, 1, key_file, keypair_file, 0.1)
+            keys = self.read_in(key_file).keys[::3]
+            with open(keypair_file, newline='', encoding='utf8') as csvfile:
+                rows = [row for row in csv.DictReader(csvfile) if
+                    row['key'].split(" ")[0] in keys and
+                    row['key'].split(" ")[1] in keys]
+
+            for use_index in (False, True, True):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    keypair_data = ks.read_in_keypair_data(keypair_file, keys,
+                        use_index)
+                self.assertEqual(sorted(zip(keypair_data.keys,
+                    keypair_data.traffic)), sorted((row['key'],
+                    float(row['traffic'])) for row in rows))
+                for column in self.COLUMNS:
+                    self.assertEqual(sorted(getattr(keypair_data, column)),
+                        sorted(float(row[column]) for row in rows))
+
+    def test_read_in_malformed(self):
+        # Rows of other length than the header are rejected, even if the
+        # number of cells of all rows adds up
+        with tempfile.TemporaryDirectory() as data_dir:
+            file = os.path.join(data_dir, 'keys.csv')
+            with open(file, 'w', encoding='utf8') as csvfile:
+                csvfile.write("key,traffic,iphone_diff,iphone_apps,ipad_diff,"
+                    "ipad_apps\nmath,1,2,3,4\n7,1,2,3,4,5,6\n")
+            self.assertEqual(self.read_in(file).keys, [])
+
+if __name__ == '__main__':
+    unittest.main()